@@ -22,6 +22,24 @@ class GenericConversation(object):
         # Extra eos tokens
         self.extra_eos_tokens = []
 
+        # Name of the model which tokenized the last prompt, the last prompt, and its token ids. This allows to
+        # only tokenize the new part of the prompt at the next turn
+        self._tokenized_prefix = None
+
+        # Token ids of the last prompt (without its last token), the corresponding K-V cache, and the model which
+        # computed it. This allows to only process the new tokens at the next turn
+        self._cached_input_ids = None
+        self._cached_past = None
+        self._cache_owner = None
+
+
+    def __getstate__(self) -> dict:
+        """Do not copy (or pickle) the K-V cache, which may be very large and lives on the gpu.
+        """
+        state = self.__dict__.copy()
+        state.update(_cached_input_ids=None, _cached_past=None, _cache_owner=None)
+        return state
+
 
     def __len__(self) -> int:
         """Return the length of the current conversation.
@@ -99,31 +117,77 @@ class GenericConversation(object):
         """Format the prompt representing the conversation that we will feed to the tokenizer.
         """
 
+        prompt = [self._format_system_prompt()]
+        for i, (user_message, model_response) in enumerate(self):
+            prompt.append(self._format_turn(i, user_message, model_response))
+
+        return ''.join(prompt)
+    
+
+    def _format_system_prompt(self) -> str:
+        """Format the start of the prompt, before the first turn.
+        """
+        return ''
+    
+
+    def _format_turn(self, i: int, user_message: str, model_response: str | None) -> str:
+        """Format the `i`-th turn of the conversation.
+        """
+
         # This seems to be the accepted way to treat inputs for conversation with a model that was not specifically
         # fine-tuned for conversation. This is the DialoGPT way of handling conversation, but is in fact reused by
         # all other tokenizers that we use.
 
-        prompt = ''
+        turn = user_message + self.eos_token
+        if model_response is not None:
+            turn += model_response + self.eos_token
 
-        for user_message, model_response in self:
+        return turn
+    
+
+    def prepare_for_generation(self, system_prompt: str, user_prompt: str) -> str:
+        """Set the system prompt, append a new user message, and return the formatted prompt to feed to the
+        tokenizer, in a single call.
 
-            prompt += user_message + self.eos_token
-            if model_response is not None:
-                prompt += model_response + self.eos_token
+        Parameters
+        ----------
+        system_prompt : str
+            The system prompt.
+        user_prompt : str
+            The user message.
+
+        Returns
+        -------
+        str
+            The formatted prompt.
+        """
 
-        return prompt
+        self.set_system_prompt(system_prompt)
+        self.append_user_message(user_prompt)
+        return self.get_prompt()
     
 
     def get_extra_eos(self) -> list[str]:
         return self.extra_eos_tokens
     
 
+    def erase_cache(self):
+        """Erase the K-V cache and tokenized prompt of the conversation, to free the memory.
+        """
+
+        self._cached_input_ids = None
+        self._cached_past = None
+        self._cache_owner = None
+        self._tokenized_prefix = None
+    
+
     def erase_conversation(self):
         """Reinitialize the conversation.
         """
 
         self.user_history_text = []
         self.model_history_text = []
+        self.erase_cache()
 
     
     def set_conversation(self, past_user_inputs: list[str], past_model_outputs: list[str]):
@@ -132,6 +196,7 @@ class GenericConversation(object):
 
         self.user_history_text = past_user_inputs
         self.model_history_text = past_model_outputs
+        self.erase_cache()
 
 
     def to_gradio_format(self) -> list[list[str, str]]:
@@ -161,21 +226,23 @@ class StarChatConversation(GenericConversation):
         self.extra_eos_tokens = [self.sep_token]
 
 
-    def get_prompt(self) -> str:
-        """Format the prompt representing the conversation that we will feed to the tokenizer.
+    def _format_system_prompt(self) -> str:
+        """Format the start of the prompt, before the first turn.
         """
-        
-        prompt = self.system_token + '\n' + self.system_prompt + self.sep_token + '\n'
+        return self.system_token + '\n' + self.system_prompt + self.sep_token + '\n'
+    
 
-        for user_message, model_response in self:
+    def _format_turn(self, i: int, user_message: str, model_response: str | None) -> str:
+        """Format the `i`-th turn of the conversation.
+        """
 
-            prompt += self.user_token + '\n' + user_message + self.sep_token + '\n'
-            if model_response is not None:
-                prompt += self.assistant_token + '\n' + model_response + self.sep_token + '\n'
-            else:
-                prompt += self.assistant_token + '\n'
+        turn = self.user_token + '\n' + user_message + self.sep_token + '\n'
+        if model_response is not None:
+            turn += self.assistant_token + '\n' + model_response + self.sep_token + '\n'
+        else:
+            turn += self.assistant_token + '\n'
 
-        return prompt
+        return turn
     
 
 # reference: https://github.com/lm-sys/FastChat/blob/main/fastchat/conversation.py#L334
@@ -192,21 +259,23 @@ class VicunaConversation(GenericConversation):
         self.assistant_token = 'ASSISTANT'
 
 
-    def get_prompt(self) -> str:
-        """Format the prompt representing the conversation that we will feed to the tokenizer.
+    def _format_system_prompt(self) -> str:
+        """Format the start of the prompt, before the first turn.
         """
+        return self.system_prompt + ' ' if self.system_prompt != '' else ''
+    
 
-        prompt = self.system_prompt + ' ' if self.system_prompt != '' else ''
-
-        for user_message, model_response in self:
+    def _format_turn(self, i: int, user_message: str, model_response: str | None) -> str:
+        """Format the `i`-th turn of the conversation.
+        """
 
-            prompt += self.user_token + ': ' + user_message + ' '
-            if model_response is not None:
-                prompt += self.assistant_token + ': ' + model_response + self.eos_token
-            else:
-                prompt += self.assistant_token + ':'
+        turn = self.user_token + ': ' + user_message + ' '
+        if model_response is not None:
+            turn += self.assistant_token + ': ' + model_response + self.eos_token
+        else:
+            turn += self.assistant_token + ':'
 
-        return prompt
+        return turn
     
 
 # reference: https://github.com/facebookresearch/llama/blob/1a240688810f8036049e8da36b073f63d2ac552c/llama/generation.py#L212
@@ -231,27 +300,23 @@ class Llama2ChatConversation(GenericConversation):
         self.assistant_token = '[/INST]'
 
 
-    def get_prompt(self) -> str:
-        """Format the prompt representing the conversation that we will feed to the tokenizer.
+    def _format_turn(self, i: int, user_message: str, model_response: str | None) -> str:
+        """Format the `i`-th turn of the conversation.
         """
 
-        system_prompt = self.system_template.format(system_prompt=self.system_prompt.strip())
-        prompt = ''
-
-        for i, (user_message, model_response) in enumerate(self):
+        if i == 0:
+            system_prompt = self.system_template.format(system_prompt=self.system_prompt.strip())
+            # Do not add bos_token here as it will be added automatically at the start of the prompt by 
+            # the tokenizer 
+            turn = self.user_token + ' ' + system_prompt + user_message.strip() + ' '
+        else:
+            turn = self.bos_token + self.user_token + ' ' + user_message.strip() + ' '
+        if model_response is not None:
+            turn += self.assistant_token + ' ' + model_response.strip() + ' ' + self.eos_token
+        else:
+            turn += self.assistant_token
 
-            if i == 0:
-                # Do not add bos_token here as it will be added automatically at the start of the prompt by 
-                # the tokenizer 
-                prompt += self.user_token + ' ' + system_prompt + user_message.strip() + ' '
-            else:
-                prompt += self.bos_token + self.user_token + ' ' + user_message.strip() + ' '
-            if model_response is not None:
-                prompt += self.assistant_token + ' ' + model_response.strip() + ' ' + self.eos_token
-            else:
-                prompt += self.assistant_token
-
-        return prompt
+        return turn
     
 
 
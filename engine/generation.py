@@ -1,14 +1,17 @@
 import os
 import warnings
 import gc
-import psutil
-import math
 import copy
+import threading
+import importlib.util
+from functools import cached_property, lru_cache
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
 import torch
-import scipy
 import numpy as np
-from transformers import StoppingCriteriaList, GenerationConfig
+from transformers import StoppingCriteriaList, LogitsProcessorList, GenerationConfig, TextIteratorStreamer
 
 from engine import loader
 from engine import stopping
@@ -18,14 +21,69 @@ from engine.code_parser import CodeParser
 from helpers import utils
 
 
+# Supported generation backends
+BACKENDS = ('hf', 'vllm')
+
+# Number of characters on each side of the boundary between the previous and new parts of a conversation prompt
+# which are tokenized again to check that the new part can be tokenized on its own
+DELTA_TOKENIZATION_WINDOW = 16
+
+# Fraction of the free gpu memory (after loading the HF model) given to the vLLM engine, the rest being kept
+# for generations falling back to the hf backend
+VLLM_FREE_MEMORY_FRACTION = 0.7
+
+# Getters of the special token ids of a `HFModel`, by decreasing order of priority
+_TOKEN_ID_GETTERS = {
+    name: tuple(attrgetter(f'{source}.{name}') for source in ('model.generation_config', 'model.config', 'tokenizer'))
+    for name in ('eos_token_id', 'bos_token_id', 'pad_token_id')
+}
+
+
+def _supports_cache_implementation(cache_implementation: str) -> bool:
+    """Check if the installed version of transformers supports `cache_implementation` in `GenerationConfig`."""
+    try:
+        from transformers.generation.configuration_utils import ALL_CACHE_IMPLEMENTATIONS
+    except ImportError:
+        return False
+    return cache_implementation in ALL_CACHE_IMPLEMENTATIONS
+
+
+def _to_legacy_cache(past_key_values) -> tuple[tuple[torch.Tensor]]:
+    """Convert `past_key_values` to the legacy format (a tuple of (key, value) tuples for each layer). Recent
+    versions of transformers return `Cache` objects, which `generate()` extends in-place: a cache which is reused
+    by several calls to `generate()` must be stored in the legacy format, which is never modified.
+    """
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
 class HFModel(object):
     """Class encapsulating a HuggingFace model and its tokenizer to generate text. 
     """
 
     def __init__(self, model_name: str, quantization_8bits: bool = False, quantization_4bits: bool = False,
                  dtype: torch.dtype | None = None, max_fraction_gpu_0: float = 0.8, max_fraction_gpus: float = 0.8,
-                 device_map: dict | str | None = None, gpu_rank: int = 0):
+                 device_map: dict | str | None = None, gpu_rank: int = 0, backend: str = 'hf',
+                 compile_model: bool = False, reserve_memory_pool: bool = False, dynamic_batching: bool = False):
         
+        if backend not in BACKENDS:
+            raise ValueError(f'The backend must be one of {*BACKENDS,}.')
+
+        # Let the caching allocator expand its segments instead of creating new ones, which avoids fragmentation
+        # when the batch size changes between calls (only available since torch 2.1). Never override a
+        # configuration explicitly given by the user
+        if torch.cuda.is_available() and 'PYTORCH_CUDA_ALLOC_CONF' not in os.environ and \
+            hasattr(torch.cuda.memory, '_set_allocator_settings'):
+            torch.cuda.memory._set_allocator_settings('expandable_segments:True')
+
+        # Half precision is much faster than float32 on Ampere gpus (or newer), and bfloat16 keeps the same range
+        # as float32. Models which were trained in half precision keep their own dtype (for which we have
+        # memory estimations)
+        if dtype is None and not (quantization_8bits or quantization_4bits) and torch.cuda.is_available() and \
+            torch.cuda.get_device_capability(0)[0] >= 8 and loader.get_model_dtype(model_name) == torch.float32:
+            dtype = torch.bfloat16
+
         # Save the current allocated memory on each gpu to estimate model size after loading
         if torch.cuda.is_available():
             reference_memory = {}
@@ -65,6 +123,15 @@ class HFModel(object):
             if device != -1:
                 self.gpu_memory_map[device] = (torch.cuda.memory_allocated(device) - reference_memory[device]) / 1024**3
 
+        # Side stream used to copy the outputs to the cpu while the next ones are being generated
+        self._copy_stream = torch.cuda.Stream(device=self.input_device) if self.input_device != 'cpu' else None
+
+        # Page-locked staging buffer (allocated on first use) to copy the inputs to the gpu without blocking,
+        # and event recorded after the last copy from it
+        self._pinned_input = None
+        self._pinned_input_copied = None
+        self._pinned_input_lock = threading.Lock()
+
         # Maximum memory taken by the model on gpus, or on the cpu
         if len(self.gpu_memory_map) > 0:
             self.max_memory_footprint = max(self.gpu_memory_map.values())
@@ -72,12 +139,34 @@ class HFModel(object):
             # Estimate the footprint via the number of parameters in this case
             self.max_memory_footprint = self.model.get_memory_footprint() / 1024**3
 
+        # Optionally grow the memory pool of the caching allocator once on the input device, so that subsequent
+        # calls to `generate()` reuse the cached segments instead of calling cudaMalloc every time. This is opt-in
+        # because the reserved memory is then unavailable to other processes on the same gpu
+        if reserve_memory_pool and self.input_device != 'cpu':
+            torch.cuda.empty_cache()
+            free_memory, _ = torch.cuda.mem_get_info(self.input_device)
+            reserved_pool = torch.empty(int(free_memory*0.9), dtype=torch.uint8, device=self.input_device)
+            del reserved_pool
+
         self.model_name = model_name
         self.quantization_8bits = quantization_8bits
         self.quantization_4bits = quantization_4bits
         # May be different from the dtype given in the arguments so use the model attribute
         self.dtype = self.model.dtype
-
+        self._dtype_category = self._compute_dtype_category()
+
+        # bitsandbytes quantization saves memory, but dequantizing the weights at each forward makes inference
+        # slower than half precision, except for large models
+        if torch.cuda.is_available() and (quantization_8bits or quantization_4bits):
+            parameters = self.parameters_count
+            if quantization_8bits and parameters < 13:
+                warnings.warn(('bitsandbytes 8 bits quantization is usually much slower than float16 inference for '
+                               'models with less than 13B parameters. Consider loading the model without '
+                               'quantization if it fits in memory.'), RuntimeWarning)
+            elif quantization_4bits and parameters < 7:
+                warnings.warn(('bitsandbytes 4 bits quantization is usually slower than float16 inference for '
+                               'models with less than 7B parameters. Consider loading the model without '
+                               'quantization if it fits in memory.'), RuntimeWarning)
 
         # Initialize the prompt template to use 
         self.prompt_template = get_prompt_template(self.model_name)
@@ -85,18 +174,230 @@ class HFModel(object):
         # Extra eos tokens
         self.extra_eos_tokens = self.prompt_template.get_extra_eos()
 
+        # Pre-encode the extra eos tokens so that the stopping criteria can check them directly on the generated
+        # ids. This is only possible if each of them is a single token of the vocabulary
+        self._extra_eos_tokens_ids = None
+        if len(self.extra_eos_tokens) > 0:
+            extra_eos_tokens_ids = self.tokenizer.convert_tokens_to_ids(self.extra_eos_tokens)
+            if None not in extra_eos_tokens_ids and \
+                self.tokenizer.convert_ids_to_tokens(extra_eos_tokens_ids) == list(self.extra_eos_tokens):
+                self._extra_eos_tokens_ids = torch.tensor(extra_eos_tokens_ids, device=self.input_device)
+
         # Flag to check if the model is a chat model by default
         self._is_chat_model = self.prompt_template.default_mode == 'chat'
 
+        # Memoize the tokenization of the last formatted prompts, as the same (possibly very long) prompts are
+        # often used multiple times in a row. We cache the tokenizer method directly (and not a method of `self`)
+        # so that the cache does not hold a reference to the model
+        self._encode_prompt = lru_cache(maxsize=8)(self.tokenizer.encode)
+
+        # Tokenizing only the end of a text gives the same tokens as tokenizing the full text for byte-level BPE
+        # tokenizers, but not for sentencepiece ones, which add a space at the start of each text
+        self._delta_tokenization = self.tokenizer('Hello world', add_special_tokens=False).input_ids == \
+            self.tokenizer('Hello', add_special_tokens=False).input_ids + \
+            self.tokenizer(' world', add_special_tokens=False).input_ids
+
+        # Resolve the special token ids once, and keep a template config from which to create new configs
+        self._eos_id, self._bos_id, self._pad_id = self._resolve_special_token_ids()
+        self._base_generation_config = GenerationConfig(eos_token_id=self._eos_id, bos_token_id=self._bos_id,
+                                                        pad_token_id=self._pad_id)
+
+        # Whether the K-V cache of the conversations can be reused between turns. This is disabled the first time
+        # we find that the model does not use the usual cache layout
+        self._reuse_conversation_cache = True
+
+        # Largest batch sizes known to fit in memory with the default K-V cache, smallest ones known to cause an OOM,
+        # and (batch size, cache_implementation, cache_config) of the K-V cache fallbacks which fitted after an OOM,
+        # by sequence length rounded up to the next power of 2
+        self._batch_size_cache = {}
+        self._oom_batch_size_cache = {}
+        self._kv_cache_fallbacks = {}
+
+        # Whether to re-pack the unfinished sequences into new batches when generating more sequences than the batch
+        # size (see `dynamic_batch_generation`). This is opt-in, as the sequences which already started are processed
+        # again from the prompt at each re-packing, which only pays off if their lengths vary a lot
+        self._dynamic_batching = dynamic_batching
+
+        # Whether the model uses a static K-V cache, with which we cannot pass our own cache to `generate()`
+        self._static_cache = False
+        if compile_model:
+            self._compile_model()
+
+        # Whether the K-V cache can be offloaded to the cpu (and streamed back to the gpu layer by layer) in case
+        # of memory overflow, instead of reducing the batch size
+        self._can_offload_kv_cache = self.input_device != 'cpu' and not self._static_cache and \
+            _supports_cache_implementation('offloaded')
+        
+        # Whether the K-V cache can be quantized to int8 with HQQ in case of memory overflow. This halves its size
+        # (and the memory reads at each decoding step), at the cost of a small loss of precision
+        self._can_quantize_kv_cache = self.input_device != 'cpu' and not self._static_cache and \
+            _supports_cache_implementation('quantized') and getattr(self.model, '_supports_quantized_cache', False) \
+            and importlib.util.find_spec('hqq') is not None
+
+        # vLLM manages the K-V cache by fixed-size pages instead of one contiguous buffer per sequence, which
+        # wastes much less memory and thus allows to generate many more sequences at once. We still keep the HF
+        # model as everything else (memory estimations, dynamic batching, streaming) relies on it. Note that the
+        # weights are then on the gpu twice
+        self._vllm_engine = self._load_vllm_engine() if backend == 'vllm' else None
+        self.backend = 'hf' if self._vllm_engine is None else 'vllm'
+        self._warned_vllm_fallback = False
+
     
-    def dtype_category(self) -> str:
-        """Return a string representation of the model dtype."""
+    def _compile_model(self):
+        """Compile the forward of the model with CUDA graphs to remove the kernel launch overhead of each decoding
+        step, which dominates the decoding time for small batches. The graphs can only be replayed if the shapes
+        do not change between steps, so this needs a static K-V cache (transformers>=4.38).
+        """
+
+        if self.input_device == 'cpu' or not hasattr(self._base_generation_config, 'cache_implementation'):
+            warnings.warn(('Compiling the model needs a gpu and a static K-V cache (transformers>=4.38). The model '
+                           'will not be compiled.'), RuntimeWarning)
+            return
+        
+        if not getattr(self.model, '_supports_static_cache', False):
+            warnings.warn(f'{self.model_name} does not support a static K-V cache. The model will not be compiled.',
+                          RuntimeWarning)
+            return
+        
+        self._base_generation_config.cache_implementation = 'static'
+        self._static_cache = True
+        self._reuse_conversation_cache = False
+        # Graph breaks (e.g. in the generation utilities of some models) fall back to eager mode instead of failing.
+        # The prompt lengths change between calls, so mark the shapes as dynamic instead of recompiling each time
+        self.model.forward = torch.compile(self.model.forward, mode='reduce-overhead', fullgraph=False, dynamic=True)
+
+        # The compilation happens during the first calls, so warm up before the first actual generation
+        warmup_input = self._copy_input_to_device(self.tokenizer('Hello', return_tensors='pt').input_ids)
+        warmup_config = copy.copy(self._base_generation_config)
+        warmup_config.update(max_new_tokens=4, do_sample=False)
+        with torch.inference_mode():
+            self.model.generate(warmup_input, generation_config=warmup_config)
+
+
+    def _load_vllm_engine(self):
+        """Load the vLLM engine corresponding to the current model, or return None (and fall back to the HF
+        backend) if this is not possible.
+        """
+
+        if self.quantization_8bits or self.quantization_4bits or self.input_device == 'cpu':
+            warnings.warn(('The vllm backend only supports non-quantized models on gpu. Falling back to the hf '
+                           'backend.'), RuntimeWarning)
+            return None
+        
+        # vLLM always loads the model on the default gpu, which must then be the one of the HF model for the memory
+        # to be accounted correctly
+        if self.input_device != torch.cuda.current_device():
+            warnings.warn((f'The vllm backend can only run on the default gpu ({torch.cuda.current_device()}), but '
+                           f'the model is on gpu {self.input_device}. Falling back to the hf backend.'), RuntimeWarning)
+            return None
+        
+        try:
+            import vllm
+        except ImportError:
+            warnings.warn('vllm is not installed. Falling back to the hf backend.', RuntimeWarning)
+            return None
+        
+        tokenizer_kwargs = loader.ALL_MODELS_ADDITIONAL_TOKENIZER_KWARGS.get(self.model_name, {})
+        model_kwargs = loader.ALL_MODELS_ADDITIONAL_MODEL_KWARGS.get(self.model_name, {})
+
+        # The weights are loaded a second time by vLLM, on top of the HF model which is already on the gpu.
+        # `gpu_memory_utilization` is the fraction of the total gpu memory that vLLM may use, including the memory
+        # already used (i.e. the HF model), so only give it part of the memory left, and keep the rest for the
+        # generations which fall back to the hf backend
+        free_memory, total_memory = torch.cuda.mem_get_info(self.input_device)
+        gpu_memory_utilization = (total_memory - (1 - VLLM_FREE_MEMORY_FRACTION) * free_memory) / total_memory
+
+        # vLLM does not support all the architectures of the HF models
+        try:
+            return vllm.LLM(model=loader.ALL_MODELS_MAPPING[self.model_name], dtype=self.dtype_category(),
+                            tokenizer_mode='auto' if tokenizer_kwargs.get('use_fast', True) else 'slow',
+                            trust_remote_code=model_kwargs.get('trust_remote_code', False),
+                            gpu_memory_utilization=gpu_memory_utilization, block_size=16)
+        except ValueError as e:
+            warnings.warn(f'Cannot load {self.model_name} with vllm ({e}). Falling back to the hf backend.',
+                          RuntimeWarning)
+            return None
+        
+
+    def _use_vllm_backend(self, generate_kwargs: dict) -> bool:
+        """Check if the vLLM engine should be used for a generation with the additional `generate_kwargs`.
+        These kwargs (e.g. a streamer) are only supported by the hf backend, which is then used instead.
+        """
+
+        if self.backend != 'vllm':
+            return False
+        
+        if len(generate_kwargs) > 0:
+            # Only warn once, as the same arguments are usually passed at each call (e.g. a streamer)
+            if not self._warned_vllm_fallback:
+                warnings.warn((f'The vllm backend does not support the additional arguments {*generate_kwargs,}. '
+                               'Falling back to the hf backend for these generations.'), RuntimeWarning)
+                self._warned_vllm_fallback = True
+            return False
+        
+        return True
+    
+
+    def _vllm_generate(self, input_ids: list[int], generation_config: GenerationConfig, num_return_sequences: int,
+                       stopping_patterns: list[str] | tuple[str] | None = None,
+                       seed: int | None = None) -> torch.Tensor:
+        """Generate `num_return_sequences` sequences from the tokenized prompt `input_ids` with the vLLM engine.
+        vLLM schedules the sequences and manages the memory by itself, so there is no batch size to choose.
+
+        Parameters
+        ----------
+        input_ids : list[int]
+            The tokenized prompt.
+        generation_config : GenerationConfig
+            Config which controls the text generation.
+        num_return_sequences : int
+            How many sequences to generate.
+        stopping_patterns : list[str] | tuple[str] | None, optional
+            Patterns on which to stop the generation, on top of the extra eos tokens, by default None.
+        seed : int | None, optional
+            An optional seed to force the generation to be reproducible. vLLM does not use the global torch
+            seed set by `utils.set_all_seeds`, so it must be given to each request. By default None.
+
+        Returns
+        -------
+        torch.Tensor
+            The PROMPT-TRUNCATED outputs on the cpu, right-padded with `pad_token_id`.
+        """
+
+        from vllm import SamplingParams
+
+        stop = list(self.extra_eos_tokens) + (list(stopping_patterns) if stopping_patterns is not None else [])
+        common_params = dict(max_tokens=generation_config.max_new_tokens,
+                             min_tokens=generation_config.min_new_tokens or 0, stop=stop, seed=seed)
+        # vLLM uses -1 and 1 to deactivate top_k and top_p sampling, and a temperature of 0 for greedy search
+        if generation_config.do_sample:
+            sampling_params = SamplingParams(n=num_return_sequences, temperature=generation_config.temperature,
+                                             top_k=generation_config.top_k or -1, top_p=generation_config.top_p or 1.,
+                                             **common_params)
+        else:
+            sampling_params = SamplingParams(n=1, temperature=0., **common_params)
+        
+        request_output = self._vllm_engine.generate(prompt_token_ids=[input_ids], sampling_params=sampling_params,
+                                                    use_tqdm=False)[0]
+        sequences = [torch.tensor(output.token_ids, dtype=torch.long) for output in request_output.outputs]
+
+        return torch.nn.utils.rnn.pad_sequence(sequences, batch_first=True,
+                                               padding_value=generation_config.pad_token_id)
+    
+
+    def _compute_dtype_category(self) -> str:
+        """Compute the string representation of the model dtype."""
         if self.quantization_4bits:
             return 'int4'
         elif self.quantization_8bits:
             return 'int8'
         else:
             return str(self.dtype).split('.', 1)[1]
+        
+
+    def dtype_category(self) -> str:
+        """Return a string representation of the model dtype."""
+        return self._dtype_category
 
     
     def __repr__(self) -> str:
@@ -115,7 +416,7 @@ class HFModel(object):
 
     def get_gpu_memory_footprint(self) -> dict:
         """Return the memory footprint of the model on each GPU device it uses, in GiB."""
-        return copy.deepcopy(self.gpu_memory_map)
+        return dict(self.gpu_memory_map)
     
 
     def get_memory_footprint(self) -> dict:
@@ -171,18 +472,9 @@ class HFModel(object):
         str
             The formatted prompt to use in the model forward.
         """
-        
-        # Set the template mode
-        old_mode = self.prompt_template.mode
-        self.prompt_template.set_mode(prompt_template_mode)
-
-        formatted_prompt = self.prompt_template.get_prompt(prompt, model_context=model_context, suffix=infill_suffix,
-                                                           system_prompt=system_prompt)
-        
-        # Reset template mode to previous mode
-        self.prompt_template.set_mode(old_mode)
 
-        return formatted_prompt
+        return self.prompt_template.get_prompt(prompt, model_context=model_context, suffix=infill_suffix,
+                                               system_prompt=system_prompt, mode=prompt_template_mode)
     
 
     def create_stopping_criteria(self,
@@ -211,26 +503,75 @@ class HFModel(object):
             to use if we post-process the outputs.
         """
 
-        # Possible early stopping
-        if isinstance(stopping_patterns, list) or isinstance(stopping_patterns, tuple):
-            stopping_criteria = stopping.TextPatternStopping(input_length, self.tokenizer, stopping_patterns,
-                                                             self.extra_eos_tokens, parser)
-            stopping_criteria = StoppingCriteriaList([stopping_criteria])
-        elif isinstance(stopping_patterns, bool) and stopping_patterns:
+        # Resolve the patterns
+        if isinstance(stopping_patterns, bool) and stopping_patterns:
             stopping_patterns = stopping.EXTENDED_CODE_STOP_PATTERNS
-            stopping_criteria = stopping.TextPatternStopping(input_length, self.tokenizer, stopping_patterns,
-                                                             self.extra_eos_tokens, parser)
-            stopping_criteria = StoppingCriteriaList([stopping_criteria])
-        else:
+        elif not isinstance(stopping_patterns, (list, tuple)):
             stopping_patterns = None
-            if len(self.extra_eos_tokens) == 0:
-                stopping_criteria = None
-            else:
-                stopping_criteria = stopping.TextPatternStopping(input_length, self.tokenizer, stopping_patterns,
-                                                                 self.extra_eos_tokens, parser)
-                stopping_criteria = StoppingCriteriaList([stopping_criteria])
 
-        return stopping_criteria, stopping_patterns
+        # No early stopping
+        if stopping_patterns is None and len(self.extra_eos_tokens) == 0:
+            return None, None
+        
+        stopping_criteria = stopping.TextPatternStopping(input_length, self.tokenizer, stopping_patterns,
+                                                         self.extra_eos_tokens, parser,
+                                                         extra_eos_tokens_ids=self._extra_eos_tokens_ids)
+
+        return StoppingCriteriaList([stopping_criteria]), stopping_patterns
+    
+
+    def _resolve_token_id(self, name: str) -> int | list[int] | None:
+        """Find the special token id `name` (e.g. `eos_token_id`) by looking successively into
+        `self.model.generation_config`, `self.model.config` and `self.tokenizer`.
+
+        Parameters
+        ----------
+        name : str
+            The name of the token id attribute. One of `('eos_token_id', 'bos_token_id', 'pad_token_id')`.
+
+        Returns
+        -------
+        int | list[int] | None
+            The first token id which is not `None`, or `None` if it is not found anywhere.
+        """
+
+        for getter in _TOKEN_ID_GETTERS[name]:
+            try:
+                token_id = getter(self)
+            except AttributeError:
+                continue
+            if token_id is not None:
+                return token_id
+            
+        return None
+    
+
+    def _resolve_special_token_ids(self) -> tuple[int | list[int], int | list[int], int | list[int]]:
+        """Find the `eos_token_id`, `bos_token_id` and `pad_token_id` of the model. This only needs to be done
+        once, as these never change for a given model.
+
+        Returns
+        -------
+        tuple[int | list[int], int | list[int], int | list[int]]
+            The eos, bos and pad token ids.
+        """
+
+        eos_token_id = self._resolve_token_id('eos_token_id')
+        if eos_token_id is None:
+            raise RuntimeError('Impossible to find the `eos_token_id`.')
+
+        bos_token_id = self._resolve_token_id('bos_token_id')
+        if bos_token_id is None:
+            raise RuntimeError('Impossible to find the `bos_token_id`.')
+        
+        # Set pad_token_id to eos_token_id if it does not exist. We make sure it is a known special token (eos
+        # token) that will be generated when the sequence is finished, and used to left-pad the batches.
+        # This way it is automatically removed from the sequence when using `decode(..., skip_special_tokens=True)`
+        pad_token_id = self._resolve_token_id('pad_token_id')
+        if pad_token_id is None:
+            pad_token_id = eos_token_id
+
+        return eos_token_id, bos_token_id, pad_token_id
     
 
     def create_generation_config(self, max_new_tokens: int, min_new_tokens: int, do_sample: bool,
@@ -271,44 +612,11 @@ class HFModel(object):
         if temperature == 0:
             do_sample = False
 
-        # Retrieve eos_token_id (note that the attribute exists in all cases)
-        if self.model.generation_config.eos_token_id is not None:
-            eos_token_id = self.model.generation_config.eos_token_id
-        elif self.model.config.eos_token_id is not None:
-            eos_token_id = self.model.config.eos_token_id
-        elif self.tokenizer.eos_token_id is not None:
-            eos_token_id = self.tokenizer.eos_token_id
-        else:
-            raise RuntimeError('Impossible to find the `eos_token_id`.')
-
-        # Retrieve bos_token_id (note that the attribute exists in all cases)
-        if self.model.generation_config.bos_token_id is not None:
-            bos_token_id = self.model.generation_config.bos_token_id
-        elif self.model.config.bos_token_id is not None:
-            bos_token_id = self.model.config.bos_token_id
-        elif self.tokenizer.bos_token_id is not None:
-            bos_token_id = self.tokenizer.bos_token_id
-        else:
-            raise RuntimeError('Impossible to find the `bos_token_id`.')
-        
-        # Retrieve pad_token_id and set it to eos_token_id if it does not exist (note that the attribute
-        # exists in all cases)
-        if self.model.generation_config.pad_token_id is not None:
-            pad_token_id = self.model.generation_config.pad_token_id
-        elif self.model.config.pad_token_id is not None:
-            pad_token_id = self.model.config.pad_token_id
-        elif self.tokenizer.pad_token_id is not None:
-            pad_token_id = self.tokenizer.pad_token_id
-        else:
-            # We don't really need a padding token in our case as we never need to pad, we just make sure
-            # it is a known special token (eos token) that will be generated when the sequence is finished.
-            # This way it is automatically removed from the sequence when using `decode(..., skip_special_tokens=True)`
-            pad_token_id = eos_token_id
-
-        # create the config
-        generation_config = GenerationConfig(eos_token_id=eos_token_id, bos_token_id=bos_token_id,
-                                             pad_token_id=pad_token_id, max_new_tokens=max_new_tokens,
-                                             min_new_tokens=min_new_tokens, do_sample=do_sample)
+        # Copy the template holding the special token ids instead of resolving them again
+        generation_config = copy.copy(self._base_generation_config)
+        unused = generation_config.update(max_new_tokens=max_new_tokens, min_new_tokens=min_new_tokens,
+                                          do_sample=do_sample)
+        assert len(unused) == 0, 'There is a typo in some generation config parameters.'
         
         # Add parameters to the config
         if do_sample:
@@ -441,69 +749,72 @@ class HFModel(object):
             original_prompt = formatted_prompt
 
         # Tokenize the prompt
-        input = self.tokenizer.encode(formatted_prompt, return_tensors='pt')
-        input_length = input.shape[-1]
-        if torch.cuda.is_available():
-            input = input.to(device=self.input_device)
+        input_ids = self._encode_prompt(formatted_prompt)
+        input_length = len(input_ids)
+        use_vllm = self._use_vllm_backend(kwargs)
+        # vLLM directly takes the token ids, so the prompt only needs to be on the gpu for the hf backend
+        if not use_vllm:
+            input = self._copy_input_to_device(torch.tensor([input_ids]))
 
         # Create the stopping criteria
         stopping_criteria, stopping_patterns = self.create_stopping_criteria(input_length,
                                                                              stopping_patterns=stopping_patterns,
                                                                              parser=parser)
-
-        # Infer batch size if not given
-        if batch_size is None:
-            batch_size = self.infer_best_batch_size(input_length, max_new_tokens, num_return_sequences)
-
-        # Anything larger than `num_return_sequences` is useless
-        batch_size = min(batch_size, num_return_sequences)
-
-        # This will lower the batch size if needed, in case of possible OOM. This allows to continue without crashing,
-        # by reducing the batch size automatically
-        first_output, batch_size = self.oom_safe_batch_generation(input, generation_config=generation_config,
-                                                                  stopping_criteria=stopping_criteria,
-                                                                  batch_size=batch_size,
-                                                                  **kwargs)
-
-        # If we require more sequences than the allowed batch size, we need to split the generation into
-        # multiple passes
-        if num_return_sequences > batch_size:
-            batch_sizes = [batch_size]*(num_return_sequences // batch_size)
-            remainder = num_return_sequences % batch_size
-            if remainder != 0:
-                batch_sizes += [remainder]
-            assert sum(batch_sizes) == num_return_sequences
-        else:
-            batch_sizes = [num_return_sequences]
-
-        generated_text = []
-
-        for i, size in enumerate(batch_sizes):
-
-            # Do not recompute the first batch of outputs
-            if i == 0:
-                outputs = first_output
-            else:
-                outputs = self.model.generate(input, generation_config=generation_config,
-                                              stopping_criteria=stopping_criteria, num_return_sequences=size,
-                                              **kwargs)
-                
+        
+        # vLLM batches the sequences by itself
+        if use_vllm:
+            # The patterns are applied on the parsed sequences when using a parser
+            truncated_outputs = self._vllm_generate(list(input_ids), generation_config, num_return_sequences,
+                                                    stopping_patterns=stopping_patterns if parser is None else None,
+                                                    seed=seed)
+            generated_text = self._post_process_outputs(truncated_outputs, None, post_process_output,
+                                                        stopping_patterns, parser)
+
+        # Fast path for the most common case of a single sequence: there is no batch size to estimate, nor batches
+        # to split. This still recovers from OOMs by quantizing or offloading the K-V cache
+        elif num_return_sequences == 1 and batch_size is None:
+            outputs, _ = self.oom_safe_batch_generation(input, generation_config=generation_config,
+                                                        stopping_criteria=stopping_criteria, batch_size=1, **kwargs)
             # Truncate the prompt from the output
             truncated_outputs = outputs[:, input_length:]
-
-            # Post-process the sequences according to stopping patterns and extra eos
-            if post_process_output:
-                generated_batch = stopping.post_process_sequences(truncated_outputs, self.tokenizer, stopping_patterns,
-                                                                  self.extra_eos_tokens, parser)
+            generated_text = self._post_process_outputs(truncated_outputs, None, post_process_output,
+                                                        stopping_patterns, parser)
+        
+        else:
+            # Infer batch size if not given
+            if batch_size is None:
+                batch_size = self.infer_best_batch_size(input_length, max_new_tokens, num_return_sequences)
+
+            # Anything larger than `num_return_sequences` is useless
+            batch_size = min(batch_size, num_return_sequences)
+
+            # If we require more sequences than the allowed batch size, we need to split the generation into
+            # multiple batches (and optionally re-pack the unfinished sequences into new batches as soon as some
+            # sequences are done). This will also lower the batch size if needed, in case of possible OOM. This
+            # allows to continue without crashing, by reducing the batch size automatically.
+            # The finished sequences are copied to the cpu and post-processed in another thread, while the gpu keeps
+            # generating the other sequences
+            if self._dynamic_batching:
+                batches = self.dynamic_batch_generation(input, generation_config=generation_config,
+                                                        stopping_patterns=stopping_patterns, parser=parser,
+                                                        batch_size=batch_size,
+                                                        num_return_sequences=num_return_sequences, **kwargs)
             else:
-                generated_batch = self.tokenizer.batch_decode(truncated_outputs, skip_special_tokens=False)
-            
-            # reattach the prompt if needed
-            if not truncate_prompt_from_output:
-                generated_batch = [original_prompt + sequence for sequence in generated_batch]
-                # generated_batch = [formatted_prompt + sequence for sequence in generated_batch]
-            
-            generated_text += generated_batch
+                batches = self.batch_generation(input, generation_config=generation_config,
+                                                stopping_criteria=stopping_criteria, batch_size=batch_size,
+                                                num_return_sequences=num_return_sequences, **kwargs)
+            with torch.inference_mode(), ThreadPoolExecutor(max_workers=1) as executor:
+                futures = []
+                for truncated_outputs in batches:
+                    truncated_outputs, copy_done = self._async_copy_to_host(truncated_outputs)
+                    futures.append(executor.submit(self._post_process_outputs, truncated_outputs, copy_done,
+                                                   post_process_output, stopping_patterns, parser))
+                    
+                generated_text = [sequence for future in futures for sequence in future.result()]
+        
+        # reattach the prompt if needed
+        if not truncate_prompt_from_output:
+            generated_text = [original_prompt + sequence for sequence in generated_text]
 
         # In this case return a str instead of list[str]
         if num_return_sequences == 1:
@@ -517,6 +828,358 @@ class HFModel(object):
         return self.generate_text(*args, **kwargs)
     
 
+    def _compute_prompt_cache(self, input: torch.Tensor) -> tuple[tuple[torch.Tensor]] | None:
+        """Compute the K-V cache of `input[:, :-1]`, to share it between several batches of new sequences generated
+        from the same prompt (the last token of the prompt is fed to `generate()` to obtain the first logits).
+        Returns None if this is not possible, i.e. for models which do not use the usual cache layout
+        (batch, heads, sequence, head_dim), or with a static cache.
+        """
+
+        if input.shape[-1] < 2 or self._static_cache:
+            return None
+        
+        with torch.no_grad():
+            prompt_cache = _to_legacy_cache(self.model(input[:, :-1], use_cache=True).past_key_values)
+        if not all(tensor.dim() == 4 for layer in prompt_cache for tensor in layer):
+            return None
+        
+        return prompt_cache
+    
+
+    def batch_generation(self, input: torch.Tensor, generation_config: GenerationConfig,
+                         stopping_criteria: StoppingCriteriaList | None, batch_size: int, num_return_sequences: int,
+                         **kwargs) -> Iterator[torch.Tensor]:
+        """Generate `num_return_sequences` sequences from the same `input`, with successive batches of at most
+        `batch_size` new sequences. As all the sequences of all batches start from the same prompt, the K-V cache of
+        the prompt is computed only once and shared between all the batches.
+
+        Parameters
+        ----------
+        input : torch.Tensor
+            The tokenized prompt, of shape (1, input_length).
+        generation_config : GenerationConfig
+            Config which controls the text generation.
+        stopping_criteria : StoppingCriteriaList | None
+            The stopping criteria to use.
+        batch_size : int
+            Max batch size for the model forward pass.
+        num_return_sequences : int
+            How many sequences to generate.
+
+        Yields
+        ------
+        torch.Tensor
+            The PROMPT-TRUNCATED outputs of each batch.
+        """
+
+        input_length = input.shape[-1]
+        prompt_cache = self._compute_prompt_cache(input) if num_return_sequences > batch_size else None
+
+        remaining = num_return_sequences
+        while remaining > 0:
+            # This will lower the batch size if needed, in case of possible OOM
+            outputs, batch_size = self.oom_safe_batch_generation(input, generation_config=generation_config,
+                                                                 stopping_criteria=stopping_criteria,
+                                                                 batch_size=min(batch_size, remaining),
+                                                                 past_key_values=prompt_cache, **kwargs)
+            remaining -= len(outputs)
+            yield outputs[:, input_length:]
+    
+
+    def dynamic_batch_generation(self, input: torch.Tensor, generation_config: GenerationConfig,
+                                 stopping_patterns: list[str] | tuple[str] | None, parser: CodeParser | None,
+                                 batch_size: int, num_return_sequences: int, **kwargs) -> Iterator[torch.Tensor]:
+        """Generate `num_return_sequences` sequences from the same `input`, with batches of at most `batch_size`.
+        If there are more sequences than `batch_size`, the batch is filled with the longest unfinished sequences
+        first, then topped up with new ones, and generation stops as soon as one of the sequences is finished
+        (eos, extra eos, stopping patterns or `max_new_tokens`). The finished sequences are then removed, and the
+        freed places are given to new sequences. This way, a sequence finishing early does not keep its place in
+        the batch idle until the longest sequence is done.
+        Note that `model.generate()` cannot resume from a re-packed K-V cache, thus the sequences that already
+        started are processed again from the prompt each time a place is freed. This is only faster than
+        `batch_generation` if the lengths of the sequences vary a lot, which is why it is only used if the model
+        was created with `dynamic_batching=True`.
+        The finished sequences are yielded as soon as they are done, so that they can be post-processed while
+        the other sequences are being generated.
+
+        Parameters
+        ----------
+        input : torch.Tensor
+            The tokenized prompt, of shape (1, input_length).
+        generation_config : GenerationConfig
+            Config which controls the text generation.
+        stopping_patterns : list[str] | tuple[str] | None
+            List of words/patterns to stop the generation.
+        parser : CodeParser | None
+            A parser to extract code from generated sequences, on which the `stopping_patterns` are applied.
+        batch_size : int
+            Max batch size for the model forward pass.
+        num_return_sequences : int
+            How many sequences to generate.
+
+        Yields
+        ------
+        torch.Tensor
+            The PROMPT-TRUNCATED outputs of the sequences which finished during the last generation, right-padded
+            with `pad_token_id`.
+        """
+
+        input_length = input.shape[-1]
+        max_new_tokens = generation_config.max_new_tokens
+        min_new_tokens = generation_config.min_new_tokens if generation_config.min_new_tokens is not None else 0
+        pad_token_id = generation_config.pad_token_id
+        eos_token_id = generation_config.eos_token_id
+        eos_token_id = torch.tensor([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id,
+                                    device=input.device)
+
+        # New tokens generated so far for all sequences that are not finished yet
+        live_sequences = [input.new_empty((0,)) for _ in range(num_return_sequences)]
+
+        while len(live_sequences) > 0:
+
+            # Give priority to the longest sequences, so that they finish (and free their place) as soon as
+            # possible, and top up the batch with new sequences
+            live_sequences.sort(key=len, reverse=True)
+            batch = live_sequences[:batch_size]
+            longest = len(batch[0])
+            shortest = len(batch[-1])
+
+            # If no sequences are waiting for a place in the batch, directly generate until the end. Otherwise,
+            # generate until the longest sequence reaches `max_new_tokens`, or until any sequence is done before
+            waiting = len(live_sequences) > batch_size
+            step = max_new_tokens - (longest if waiting else shortest)
+            config = copy.copy(generation_config)
+            config.update(max_new_tokens=step, min_new_tokens=None)
+
+            # In this case, all sequences only consist of the prompt so we sample them directly from the input.
+            # This is only the case of the first batch, as the next ones are always topped up with new sequences,
+            # so there is no point in sharing the K-V cache of the prompt between batches
+            if longest == 0:
+                batch_input = input
+                batch_kwargs = {}
+            # Else, left-pad the prompt + sequences to the longest sequence of the batch
+            else:
+                batch_input = input.new_full((len(batch), input_length + longest), pad_token_id)
+                attention_mask = torch.zeros_like(batch_input)
+                for i, sequence in enumerate(batch):
+                    length = input_length + len(sequence)
+                    batch_input[i, -length:] = torch.cat([input[0], sequence])
+                    attention_mask[i, -length:] = 1
+                batch_kwargs = {'attention_mask': attention_mask}
+
+            batch_input_length = batch_input.shape[-1]
+            stopping_criteria, _ = self.create_stopping_criteria(batch_input_length, stopping_patterns, parser)
+
+            # Each sequence must reach `min_new_tokens` on its own, independently of the other ones
+            if min_new_tokens > 0:
+                sequences_min_new_tokens = torch.tensor([min_new_tokens - len(sequence) for sequence in batch],
+                                                        device=input.device)
+                min_tokens_processor = stopping.SequenceMinNewTokensLogitsProcessor(batch_input_length,
+                                                                                     sequences_min_new_tokens,
+                                                                                     eos_token_id)
+                batch_kwargs['logits_processor'] = LogitsProcessorList([min_tokens_processor])
+
+            generation_criteria = stopping_criteria
+            if waiting:
+                pattern_stopping = stopping_criteria[0] if stopping_criteria is not None else None
+                generation_criteria = StoppingCriteriaList([stopping.FirstSequenceStopping(batch_input_length,
+                                                                                           eos_token_id,
+                                                                                           pattern_stopping)])
+
+            # This will lower the batch size if needed, in case of possible OOM
+            outputs, batch_size = self.oom_safe_batch_generation(batch_input, generation_config=config,
+                                                                 stopping_criteria=generation_criteria,
+                                                                 batch_size=len(batch), **batch_kwargs, **kwargs)
+            batch = batch[:batch_size]
+
+            del live_sequences[:len(batch)]
+            new_tokens = outputs[:, batch_input_length:]
+
+            # Sequences which did not generate an eos yet
+            finished_sequences = []
+            unfinished = []
+            for sequence, tokens in zip(batch, new_tokens):
+                eos_positions = torch.nonzero(torch.isin(tokens, eos_token_id))
+                # Everything after the eos is padding
+                if len(eos_positions) > 0:
+                    stop_index = int(eos_positions[0][0]) + 1
+                    finished_sequences.append(torch.cat([sequence, tokens[:stop_index]])[:max_new_tokens])
+                else:
+                    unfinished.append(torch.cat([sequence, tokens]))
+
+            # Check the extra eos and stopping patterns on the sequences that did not generate an eos
+            if stopping_criteria is not None and len(unfinished) > 0:
+                done_with_patterns = stopping_criteria[0].sequences_done(self.tokenizer.batch_decode(unfinished))
+            else:
+                done_with_patterns = [False]*len(unfinished)
+
+            for sequence, done in zip(unfinished, done_with_patterns):
+                if done or len(sequence) >= max_new_tokens:
+                    finished_sequences.append(sequence[:max_new_tokens])
+                else:
+                    live_sequences.append(sequence)
+
+            if len(finished_sequences) > 0:
+                yield torch.nn.utils.rnn.pad_sequence(finished_sequences, batch_first=True,
+                                                      padding_value=pad_token_id)
+    
+
+    def _copy_input_to_device(self, input: torch.Tensor) -> torch.Tensor:
+        """Copy the tokenized `input` (of any shape, usually (1, input_length)) to `self.input_device`. The copy
+        goes through a page-locked staging buffer so that it does not block the host. The buffer is reused between
+        calls, as allocating page-locked memory is slow.
+
+        Parameters
+        ----------
+        input : torch.Tensor
+            The input on the cpu.
+
+        Returns
+        -------
+        torch.Tensor
+            The input on `self.input_device`.
+        """
+
+        if self.input_device == 'cpu':
+            return input
+        
+        size = input.numel()
+
+        with self._pinned_input_lock:
+            # The previous copy from the buffer must be done before overwriting it
+            if self._pinned_input_copied is not None:
+                self._pinned_input_copied.synchronize()
+
+            # Allocate the buffer with the maximum length the model can process if it is known, so that it never
+            # grows for single prompts
+            if self._pinned_input is None or self._pinned_input.numel() < size:
+                max_length = getattr(self.model.config, 'max_position_embeddings', None) or \
+                    getattr(self.model.config, 'n_positions', None) or 0
+                self._pinned_input = torch.empty(max(size, max_length), dtype=input.dtype, pin_memory=True)
+            
+            staged_input = self._pinned_input[:size].view(input.shape)
+            staged_input.copy_(input)
+            device_input = staged_input.to(device=self.input_device, non_blocking=True)
+            self._pinned_input_copied = torch.cuda.Event()
+            self._pinned_input_copied.record(torch.cuda.current_stream(self.input_device))
+
+        return device_input
+    
+
+    def _async_copy_to_host(self, tensor: torch.Tensor) -> tuple[torch.Tensor, torch.cuda.Event | None]:
+        """Copy `tensor` to the cpu on a side cuda stream, so that it does not wait for (or block) the kernels
+        launched afterwards on the default stream.
+
+        Parameters
+        ----------
+        tensor : torch.Tensor
+            The tensor to copy.
+
+        Returns
+        -------
+        tuple[torch.Tensor, torch.cuda.Event | None]
+            The copy on the cpu, and an event to synchronize with before using it (`None` if `tensor` was already
+            on the cpu).
+        """
+
+        if not tensor.is_cuda:
+            return tensor, None
+
+        self._copy_stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(self._copy_stream):
+            host_tensor = tensor.to('cpu', non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        # The memory of `tensor` must not be reused before the end of the copy on the side stream
+        tensor.record_stream(self._copy_stream)
+
+        return host_tensor, copy_done
+    
+
+    def _post_process_outputs(self, truncated_outputs: torch.Tensor, copy_done: torch.cuda.Event | None,
+                              post_process_output: bool, stopping_patterns: list[str] | tuple[str] | None,
+                              parser: CodeParser | None) -> list[str]:
+        """Decode the prompt-truncated outputs of the model, and post-process them according to the stopping
+        patterns and extra eos if `post_process_output` is True. This is meant to run in a separate thread.
+        """
+
+        if copy_done is not None:
+            copy_done.synchronize()
+
+        if post_process_output:
+            return stopping.post_process_sequences(truncated_outputs, self.tokenizer, stopping_patterns,
+                                                   self.extra_eos_tokens, parser)
+        else:
+            return self.tokenizer.batch_decode(truncated_outputs, skip_special_tokens=False)
+    
+
+    @property
+    def _available_memory(self) -> float:
+        """Memory available for the forward passes, in GiB. On gpus, this is read live on the most loaded device
+        used by the model, and includes the memory reserved but unused by the caching allocator, which can be
+        reused without any new allocation.
+        """
+
+        if len(self.gpu_memory_map) == 0:
+            # Only import it here as it is not needed when running on gpus
+            import psutil
+            memory = psutil.virtual_memory().total / 1024**3
+            # Only take 0.85 of the memory into account in order to not completely clutter the memory
+            return memory*0.85 - self.get_max_device_memory_footprint()
+        
+        available_memory = []
+        for device in self.gpu_memory_map.keys():
+            free_memory, _ = torch.cuda.mem_get_info(device)
+            unused_reserved_memory = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+            available_memory.append(free_memory + unused_reserved_memory)
+
+        # Keep a margin in order to not completely clutter the memory
+        return 0.9 * min(available_memory) / 1024**3
+    
+
+    @cached_property
+    def _batch_fit(self) -> tuple[float, float, float, bool] | None:
+        """Linear fit of the memory footprint of a batch with respect to the sequence length, according to the
+        estimation in the folder `memory_estimator`. This is only computed the first time it is needed.
+
+        Returns
+        -------
+        tuple[float, float, float, bool] | None
+            The slope, intercept and r2 of the fit, and the flag `only_scale_with_input_size`. `None` if no
+            estimation exists for the current model and dtype.
+        """
+
+        # Try loading estimator file
+        try:
+            reference_file = os.path.join(utils.ROOT_FOLDER, 'memory_estimator', self.model_name, f'{self.dtype_category()}.json')
+            batch_footprint = utils.load_json(reference_file)
+            scale = 1.
+        except FileNotFoundError:
+            # Float32 models are loaded in bfloat16 by default on recent gpus, but were only estimated in float32:
+            # the activations and K-V cache of a batch then take half the memory
+            if self.dtype != torch.bfloat16 or loader.get_model_dtype(self.model_name) != torch.float32:
+                return None
+            try:
+                reference_file = os.path.join(utils.ROOT_FOLDER, 'memory_estimator', self.model_name, 'float32.json')
+                batch_footprint = utils.load_json(reference_file)
+                scale = 0.5
+            except FileNotFoundError:
+                return None
+        only_scale_with_input_size = batch_footprint.pop('only_scale_with_input_size', False)
+
+        # Convert keys to int
+        x = np.array([int(k) for k in batch_footprint.keys()], dtype=float)
+        y = scale * np.array(list(batch_footprint.values()), dtype=float)
+
+        # Memory usage is linear wrt to sequence length when using K-V cache
+        slope, intercept = np.polyfit(x, y, 1)
+        ss_res = np.sum((y - (intercept + slope * x))**2)
+        ss_tot = np.sum((y - y.mean())**2)
+        r2 = 1 - ss_res / ss_tot if ss_tot > 0 else 1.
+
+        return float(slope), float(intercept), float(r2), only_scale_with_input_size
+    
+
     def infer_best_batch_size(self, input_size: int, max_new_tokens: int, num_return_sequences: int) -> int:
         """Try to infer the best (largest) possible batch size for the model given the current `input_size`,
         and `max_new_tokens`. By default, this function checks if a batch memory footprint estimation exists
@@ -535,39 +1198,14 @@ class HFModel(object):
         int
             Estimation of the largest possible batch size.
         """
-    
-        if not torch.cuda.is_available():
-            memory = psutil.virtual_memory().total / 1024**3
-        else:
-            memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
 
-        # Only take 0.85 of the gpu memory into account in order to not completely clutter the memory
-        available_memory = memory*0.85 - self.get_max_device_memory_footprint()
-
-        # Try loading estimator file
-        try:
-            reference_file = os.path.join(utils.ROOT_FOLDER, 'memory_estimator', self.model_name, f'{self.dtype_category()}.json')
-            batch_footprint = utils.load_json(reference_file)
-            only_scale_with_input_size = batch_footprint.pop('only_scale_with_input_size', False)
-            # Convert keys to int
-            batch_footprint = {int(k): v for k, v in batch_footprint.items()}
-        # If no precise estimate exist, fall back to simple heuristics
-        except FileNotFoundError:
-            return self.infer_best_batch_size_by_heuristics(available_memory)
-
-
-        x = list(batch_footprint.keys())
-        y = list(batch_footprint.values())
-        # sort according to increasing sequence
-        sorting = np.argsort(x)
-        x = np.array(x)[sorting]
-        y = np.array(y)[sorting]
+        available_memory = self._available_memory
+        batch_fit = self._batch_fit
+        # If no precise estimate exist, fall back to the size of the K-V cache, or to simple heuristics
+        if batch_fit is None:
+            return self.infer_best_batch_size_by_kv_cache(available_memory, input_size, max_new_tokens)
         
-        # Memory usage is linear wrt to sequence length when using K-V cache
-        fit = scipy.stats.linregress(x, y)
-        intercept = fit.intercept
-        slope = fit.slope
-        r2 = fit.rvalue**2
+        slope, intercept, r2, only_scale_with_input_size = batch_fit
 
         # If the flag `only_scale_with_input_size` is active, the memory needed for subsequent forward passes
         # is negligible compared to the memory needed to compute the K-V cache the first time
@@ -576,16 +1214,72 @@ class HFModel(object):
         # This should always be the case, but check it if for some reason the behavior is not sufficiently linear
         if r2 >= 0.95:
             memory_needed = intercept + slope * sequence_length
-        # In this case, fall back to simple heuristics
+        # In this case, fall back to the size of the K-V cache, or to simple heuristics
         else:
-            return self.infer_best_batch_size_by_heuristics(available_memory)
+            return self.infer_best_batch_size_by_kv_cache(available_memory, input_size, max_new_tokens)
 
         return int(available_memory // memory_needed)
     
 
+    @cached_property
+    def _kv_cache_bytes_per_token(self) -> int | None:
+        """Size of the K-V cache of a single token, in bytes, according to the model config. `None` if the config
+        does not provide the needed attributes. This is only computed the first time it is needed.
+        """
+
+        config = self.model.config
+        try:
+            num_layers = config.num_hidden_layers
+            num_heads = config.num_attention_heads
+            head_dim = config.hidden_size // num_heads
+        except AttributeError:
+            return None
+        
+        # Grouped-query (e.g. llama2-70B) and multi-query (e.g. star-coder) attention share the keys and values
+        # between heads
+        num_kv_heads = getattr(config, 'num_key_value_heads', None)
+        if num_kv_heads is None:
+            num_kv_heads = 1 if getattr(config, 'multi_query', False) else num_heads
+
+        # Quantized models still use float16 for the cache
+        return 2 * num_layers * num_kv_heads * head_dim * (torch.finfo(self.dtype).bits // 8)
+    
+
+    def infer_best_batch_size_by_kv_cache(self, available_memory: float, input_size: int, max_new_tokens: int) -> int:
+        """Infer the largest possible batch size from the size of the K-V cache of a full sequence, and the size
+        of the float32 logits of the prompt computed by the first forward pass. Falls back to
+        `infer_best_batch_size_by_heuristics` if the model config does not allow to compute the cache size.
+
+        Parameters
+        ----------
+        available_memory : float
+            The memory available for the forward pass.
+        input_size : int
+            The input length.
+        max_new_tokens : int
+            The number of tokens to generate.
+
+        Returns
+        -------
+        int
+            Estimation of the largest possible batch size.
+        """
+
+        kv_cache_bytes_per_token = self._kv_cache_bytes_per_token
+        vocab_size = getattr(self.model.config, 'vocab_size', None)
+        if kv_cache_bytes_per_token is None or vocab_size is None:
+            return self.infer_best_batch_size_by_heuristics(available_memory)
+        
+        memory_needed = kv_cache_bytes_per_token * (input_size + max_new_tokens) + 4 * vocab_size * input_size
+        batch = int(available_memory * 1024**3 // memory_needed)
+
+        return max(batch, 1)
+    
+
     def infer_best_batch_size_by_heuristics(self, available_memory: float) -> int:
         """Infer the largest possible batch size using very simple and raw heuristics. It only uses the number
-        of parameters of the model, which is not a very good indicator. 
+        of parameters of the model, which is not a very good indicator. The memory needed per sequence is
+        calibrated for half precision activations, and scaled according to the size of the model dtype.
 
         Parameters
         ----------
@@ -598,57 +1292,136 @@ class HFModel(object):
             A very raw estimate of the best batch size.
         """
 
-        parameters = self.parameters_count()
+        # The activations and K-V cache of float32 models take twice as much memory as half precision ones
+        # (quantized models still use float16 activations)
+        dtype_scale = (torch.finfo(self.dtype).bits // 8) / 2
+
+        parameters = self.parameters_count
         if parameters < 5:
-            batch = int(available_memory // 0.5)
+            batch = int(available_memory // (0.5*dtype_scale))
         elif parameters < 10:
-            batch = int(available_memory // 1)
+            batch = int(available_memory // (1*dtype_scale))
         elif parameters < 20:
-            batch = int(available_memory // 2)
+            batch = int(available_memory // (2*dtype_scale))
         else:
-            batch = int(available_memory // 3)
+            batch = int(available_memory // (3*dtype_scale))
         
         return max(batch, 1)
 
 
     def oom_safe_batch_generation(self, input: torch.Tensor, generation_config: GenerationConfig,
                                   stopping_criteria: StoppingCriteriaList | None, batch_size: int,
+                                  past_key_values: tuple[tuple[torch.Tensor]] | None = None,
+                                  attention_mask: torch.Tensor | None = None,
                                   **kwargs) -> tuple[torch.Tensor, int]:
-        """Generate text by recursively recovering from possible memory errors (OOMs) by lowering the batch size.
-        Note that it is not possible to retry immediately in the except block because the exception retains the
-        tensors already allocated in the try block which causes an immediate new OOM
-        (see https://github.com/pytorch/pytorch/issues/18853)
+        """Generate text by recovering from possible memory errors (OOMs) by halving the batch size until it fits.
+        The generation is isolated in an inner function so that all the tensors allocated by a failed attempt are
+        released before retrying (the traceback of the exception would otherwise retain them, see
+        https://github.com/pytorch/pytorch/issues/18853).
+        If `past_key_values` is provided, it must be the K-V cache of `input[:, :-1]` (with batch size 1), and
+        is broadcasted to all sequences of the batch instead of computing it again.
+        If `input` has more than one row, it is already a batch of (left-padded) sequences, and only its first
+        `batch_size` rows (and those of `attention_mask`) are generated.
         """
-        retry = False
 
-        # Try generating result
-        try:
-            out = self.model.generate(input, generation_config=generation_config, stopping_criteria=stopping_criteria,
-                                      num_return_sequences=batch_size, **kwargs)
-        
-        except RuntimeError as e:
-            if isinstance(e, torch.cuda.OutOfMemoryError):
-                retry = True
+        # Inference mode additionally disables the view and version counter tracking of tensors compared to
+        # no_grad (used by `generate()`)
+        @torch.inference_mode()
+        def _try_generate(batch_size: int) -> torch.Tensor:
+            # Expand the prompt (and its cache) ourselves instead of using `num_return_sequences`, which copies them.
+            # This is only a view, the memory is allocated when the cache grows with the new tokens
+            batch_kwargs = {}
+            if past_key_values is not None:
+                batch_kwargs['past_key_values'] = tuple(tuple(tensor.expand(batch_size, -1, -1, -1) for tensor in layer)
+                                                        for layer in past_key_values)
+            if attention_mask is not None:
+                batch_kwargs['attention_mask'] = attention_mask[:batch_size]
+            batch_input = input.expand(batch_size, -1) if input.shape[0] == 1 else input[:batch_size]
+            return self.model.generate(batch_input, generation_config=generation_config,
+                                       stopping_criteria=stopping_criteria, num_return_sequences=1, **batch_kwargs,
+                                       **kwargs)
+
+        # Quantizing the K-V cache, and then offloading it to the cpu, is slower but keeps the same batch size.
+        # This cannot be combined with our own cache
+        can_quantize_kv_cache = self._can_quantize_kv_cache and past_key_values is None
+        can_offload_kv_cache = self._can_offload_kv_cache and past_key_values is None
+
+        # If the batch size is known to cause an OOM for similar sequence lengths, directly start from the K-V cache
+        # fallback which fitted the last time, or else from the largest batch size known to fit (or half of the OOM
+        # size), instead of going through the same OOMs again
+        sequence_length = input.shape[-1] + generation_config.max_new_tokens
+        bucket = 1 << (sequence_length - 1).bit_length()
+        oom_batch_size = self._oom_batch_size_cache.get(bucket)
+        fallback = self._kv_cache_fallbacks.get(bucket) if can_offload_kv_cache or can_quantize_kv_cache else None
+        use_fallback = False
+        if oom_batch_size is not None and batch_size >= oom_batch_size:
+            if fallback is not None:
+                fallback_batch_size, cache_implementation, cache_config = fallback
+                batch_size = min(batch_size, fallback_batch_size)
+                generation_config = copy.copy(generation_config)
+                generation_config.cache_implementation = cache_implementation
+                generation_config.cache_config = cache_config
+                use_fallback = True
             else:
-                raise e
-
-        if retry:
-            if batch_size == 1:
-                raise RuntimeError('Even a batch size of 1 causes an OOM. Cannot generate with current config.')
-            new_batch_size = max(1, math.floor(batch_size*0.8))
-            warnings.warn(f'Reducing batch size from {batch_size} to {new_batch_size} due to memory overflow (OOM).', RuntimeWarning)
+                batch_size = self._batch_size_cache.get(bucket, max(1, oom_batch_size // 2))
+
+        while True:
+            try:
+                out = _try_generate(batch_size)
+                # Only a batch which fitted with the default cache tells how large the batches can be with it,
+                # otherwise remember the fallback to directly start from it next time
+                if use_fallback:
+                    self._kv_cache_fallbacks[bucket] = (batch_size, generation_config.cache_implementation,
+                                                        generation_config.cache_config)
+                else:
+                    # A smaller batch fitting does not mean that larger ones would not, so only keep the largest one
+                    self._batch_size_cache[bucket] = max(self._batch_size_cache.get(bucket, 0), batch_size)
+                return out, batch_size
+            except torch.cuda.OutOfMemoryError:
+                pass
+            
+            # We are out of the except block here, so the exception and its frames are already freed
             gc.collect()
-            torch.cuda.empty_cache()
-            return self.oom_safe_batch_generation(input, generation_config=generation_config,
-                                                  stopping_criteria=stopping_criteria, batch_size=new_batch_size,
-                                                  **kwargs)
-        else:
-            return out, batch_size
+            # Releasing the cached blocks forces new cudaMalloc calls for the next allocations, so only do it if a
+            # large part of the reserved memory is unused, i.e. if the memory is actually fragmented
+            unused_reserved_memory = torch.cuda.memory_reserved(self.input_device) - \
+                torch.cuda.memory_allocated(self.input_device)
+            if unused_reserved_memory > 0.2 * torch.cuda.mem_get_info(self.input_device)[1]:
+                torch.cuda.empty_cache()
+
+            # The default cache takes at least as much memory as the fallbacks, so it would not fit either
+            oom_batch_size = min(self._oom_batch_size_cache.get(bucket, batch_size), batch_size)
+            self._oom_batch_size_cache[bucket] = oom_batch_size
+            # The memory available may have changed since a larger batch fitted
+            if self._batch_size_cache.get(bucket, 0) >= oom_batch_size:
+                del self._batch_size_cache[bucket]
+
+            cache_implementation = getattr(generation_config, 'cache_implementation', None)
+            if can_quantize_kv_cache and cache_implementation is None:
+                warnings.warn('Quantizing the K-V cache to int8 due to memory overflow (OOM).', RuntimeWarning)
+                generation_config = copy.copy(generation_config)
+                generation_config.cache_implementation = 'quantized'
+                generation_config.cache_config = {'backend': 'HQQ', 'nbits': 8}
+                use_fallback = True
+            elif can_offload_kv_cache and cache_implementation != 'offloaded':
+                warnings.warn('Offloading the K-V cache to the cpu due to memory overflow (OOM).', RuntimeWarning)
+                generation_config = copy.copy(generation_config)
+                generation_config.cache_implementation = 'offloaded'
+                generation_config.cache_config = None
+                use_fallback = True
+            elif batch_size == 1:
+                raise RuntimeError('Even a batch size of 1 causes an OOM. Cannot generate with current config.')
+            else:
+                new_batch_size = max(1, batch_size // 2)
+                warnings.warn(f'Reducing batch size from {batch_size} to {new_batch_size} due to memory overflow (OOM).', RuntimeWarning)
+                batch_size = new_batch_size
         
 
+    @cached_property
     def parameters_count(self) -> float:
         """Return the (approximate) number of parameters of the current model, in billions.
         Note that shared parameters will be counted twice by this current function, thus it is only approximate.
+        The parameters are fixed once the model is loaded, so they are only counted once.
 
         Returns
         -------
@@ -656,7 +1429,16 @@ class HFModel(object):
             The number of parameters, in billions.
         """
 
-        return sum(map(torch.numel, self.model.parameters())) / 1e9
+        count = 0
+        for parameter in self.model.parameters():
+            # bitsandbytes packs two 4 bits weights in each element of the storage (same as
+            # `PreTrainedModel.num_parameters()`)
+            if parameter.__class__.__name__ == 'Params4bit':
+                count += 2 * parameter.numel()
+            else:
+                count += parameter.numel()
+
+        return count / 1e9
     
 
     def set_prompt_template(self, template: GenericPromptTemplate):
@@ -664,6 +1446,7 @@ class HFModel(object):
         self.prompt_template = template
 
 
+    @torch.inference_mode()
     def generate_conversation(
             self,
             prompt: str,
@@ -677,8 +1460,10 @@ class HFModel(object):
             temperature: float = 0.9,
             seed: int | None = None,
             truncate_if_conv_too_long: bool = True,
+            stream: bool = False,
+            force_offload_kv: bool = False,
             **kwargs
-    ) -> GenericConversation:
+    ) -> GenericConversation | Iterator[str]:
         """Generate a conversation turn between a user and the model, according to new user input `prompt`.
 
         Input parameters
@@ -717,13 +1502,36 @@ class HFModel(object):
         truncate_if_conv_too_long : bool, optional
             Whether to truncate the conversation history if it becomes larger than the model maximum capacity,
             by default True.
+        stream : bool, optional
+            Whether to return an iterator over the new text as it is being generated, instead of waiting for the
+            full answer. In this case, `conv_history` must be provided, and is updated once the iterator is
+            exhausted (or closed, in which case the generation is interrupted and only the text generated so far
+            is added to the conversation). By default False.
+        force_offload_kv : bool, optional
+            Whether to offload the K-V cache to the cpu during generation, to save gpu memory for very long
+            conversations at the cost of speed. This needs transformers>=4.45. By default False.
 
         Returns
         -------
-        GenericConversation
-            A conversation object, with the dialogue history updated with the current turn.
+        GenericConversation | Iterator[str]
+            A conversation object, with the dialogue history updated with the current turn, or an iterator over
+            the generated text if `stream=True`.
         """
 
+        # Check that the history is not empty
+        if conv_history is None:
+            # The iterator only yields the text, so the conversation would be lost
+            if stream:
+                raise ValueError('You must provide `conv_history` when using `stream=True`.')
+            conv_history = self.get_empty_conversation()
+
+        if stream:
+            return self._stream_conversation(prompt, system_prompt=system_prompt, conv_history=conv_history,
+                                             max_new_tokens=max_new_tokens, min_new_tokens=min_new_tokens,
+                                             do_sample=do_sample, top_k=top_k, top_p=top_p, temperature=temperature,
+                                             seed=seed, truncate_if_conv_too_long=truncate_if_conv_too_long,
+                                             force_offload_kv=force_offload_kv, **kwargs)
+
         if seed is not None:
             utils.set_all_seeds(seed)
 
@@ -732,42 +1540,351 @@ class HFModel(object):
                                                           do_sample=do_sample, top_k=top_k, top_p=top_p,
                                                           temperature=temperature)
 
-        # Check that the history is not empty
-        if conv_history is None:
-            conv_history = self.get_empty_conversation()
-
-        # Set system prompt
-        conv_history.set_system_prompt(system_prompt)
-
-        # Add the prompt to the current conversation
-        conv_history.append_user_message(prompt)
+        # Set the system prompt, add the prompt to the current conversation, and generate the full prompt
+        full_prompt = conv_history.prepare_for_generation(system_prompt, prompt)
 
-        # Generate and tokenize the full prompt
-        full_prompt = conv_history.get_prompt()
-        input = self.tokenizer.encode(full_prompt, return_tensors='pt')
+        # Tokenize the full prompt
+        input = self._tokenize_conversation(conv_history, full_prompt)
         input_length = input.shape[-1]
-        if torch.cuda.is_available():
-            input = input.to(device=self.input_device)
 
-        # Create the stopping criteria in case the model has some extra eos tokens to process
-        stopping_criteria, _ = self.create_stopping_criteria(input_length)
+        use_vllm = self._use_vllm_backend(kwargs)
+        # Additional stopping criteria (e.g. to interrupt a stream) are merged with our own ones, so they must not
+        # be passed to `generate()` a second time through the kwargs
+        extra_stopping_criteria = kwargs.pop('stopping_criteria', None)
 
-        outputs = self.model.generate(input, generation_config=generation_config, stopping_criteria=stopping_criteria,
-                                      num_return_sequences=1, **kwargs)
-                
-        # Truncate the prompt from the output
-        truncated_outputs = outputs[:, input_length:]
+        if use_vllm:
+            truncated_outputs = self._vllm_generate(input[0].tolist(), generation_config, 1, seed=seed)
 
+        else:
+            input = self._copy_input_to_device(input)
+
+            if force_offload_kv and not self._can_offload_kv_cache:
+                warnings.warn('The K-V cache cannot be offloaded with the current setup. Ignoring `force_offload_kv`.',
+                              RuntimeWarning)
+                force_offload_kv = False
+
+            # The K-V cache of the previous turns cannot be combined with an offloaded (or static) cache, and
+            # `past_key_values` must then not be passed at all, even as None
+            cache_kwargs = {}
+            if force_offload_kv:
+                generation_config.cache_implementation = 'offloaded'
+            # Reuse the K-V cache of the previous turns so that only the new tokens are processed
+            else:
+                past_key_values = self._extend_conversation_cache(conv_history, input)
+                if past_key_values is not None:
+                    cache_kwargs['past_key_values'] = past_key_values
+
+            # Create the stopping criteria in case the model has some extra eos tokens to process, and add the
+            # additional ones
+            stopping_criteria, _ = self.create_stopping_criteria(input_length)
+            if extra_stopping_criteria is not None:
+                stopping_criteria = StoppingCriteriaList(list(extra_stopping_criteria) + list(stopping_criteria or []))
+
+            outputs = self.model.generate(input, generation_config=generation_config,
+                                          stopping_criteria=stopping_criteria, num_return_sequences=1, **cache_kwargs,
+                                          **kwargs)
+                    
+            # Truncate the prompt from the output
+            truncated_outputs = outputs[:, input_length:]
+
+        # If the extra eos tokens are single tokens, we can directly cut the answer at the first of them and decode
+        # it, instead of the full post-processing of (possibly) multiple sequences
+        if len(self.extra_eos_tokens) == 0 or self._extra_eos_tokens_ids is not None:
+            answer = truncated_outputs[0].contiguous()
+            if self._extra_eos_tokens_ids is not None:
+                extra_eos_ids = self._extra_eos_tokens_ids.to(answer.device)
+                eos_positions = torch.nonzero(torch.isin(answer, extra_eos_ids))
+                if len(eos_positions) > 0:
+                    answer = answer[:int(eos_positions[0][0])]
+            response = self.tokenizer.decode(answer, skip_special_tokens=True)
         # Post-process the sequences according to potential extra eos tokens
-        response = stopping.post_process_sequences(truncated_outputs, self.tokenizer, stopping_patterns=None,
-                                                   extra_eos_tokens=self.extra_eos_tokens)
+        else:
+            response = stopping.post_process_sequences(truncated_outputs, self.tokenizer, stopping_patterns=None,
+                                                       extra_eos_tokens=self.extra_eos_tokens)[0]
         
         # Append output to the conv
-        conv_history.append_model_message(response[0])
+        conv_history.append_model_message(response)
 
         return conv_history
 
 
+    def _stream_conversation(self, prompt: str, conv_history: GenericConversation, **kwargs) -> Iterator[str]:
+        """Run `generate_conversation` in another thread, and yield the new text as it is being generated.
+        `conv_history` is updated in-place once the generation is done.
+        """
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        # Keep the stopping criteria which may have been given by the caller
+        stopping_criteria = StoppingCriteriaList([stopping.EventStopping(stop_event)] +
+                                                 list(kwargs.pop('stopping_criteria', None) or []))
+
+        def _generate():
+            try:
+                self.generate_conversation(prompt, conv_history=conv_history, streamer=streamer,
+                                           stopping_criteria=stopping_criteria, **kwargs)
+            finally:
+                # Stop the iteration over the streamer even if the generation failed
+                streamer.end()
+
+        # We use an executor because it makes it easier to catch possible exceptions
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(_generate)
+            try:
+                for new_text in streamer:
+                    yield new_text
+            finally:
+                # If the iterator is closed before the end, interrupt the generation instead of waiting for it to
+                # finish when leaving the executor
+                stop_event.set()
+            # Raise the exception from the generation if any
+            future.result()
+
+
+    @torch.inference_mode()
+    def generate_conversation_batch(
+            self,
+            prompts: list[str],
+            system_prompt: str = '',
+            conv_histories: list[GenericConversation] | None = None,
+            max_new_tokens: int = 60,
+            min_new_tokens: int = 5,
+            do_sample: bool = True,
+            top_k: int = 50,
+            top_p: float = 0.90,
+            temperature: float = 0.9,
+            batch_size: int | None = None,
+            seed: int | None = None,
+            **kwargs
+    ) -> list[GenericConversation]:
+        """Generate a conversation turn in several independent conversations at once, according to the new user
+        inputs `prompts`. The prompts are tokenized in a single call, and batched by similar lengths.
+
+        Input parameters
+        ----------------
+        prompts : list[str]
+            The new prompts of the user to the model, one for each conversation.
+        system_prompt : str
+            An optional system prompt to guide the style of the model answers, common to all conversations.
+        conv_histories : list[GenericConversation] | None
+            Optional existing conversation objects, one for each prompt. If not provided, new conversations are
+            started.
+
+        Generation parameters
+        ---------------------
+
+        max_new_tokens : int, optional
+            How many new tokens to generate, by default 60.
+        min_new_tokens : int, optional
+            The minimum number of tokens to generate, by setting the probability of EOS token to 0. It is useful to
+            force the model to generate an output, instead of immediately generating EOS, by default 5.
+        do_sample : bool, optional
+            Whether to introduce randomness in the generation, by default True.
+        top_k : int | None, optional
+            How many tokens with max probability to consider for random sampling, by default 50. Not used if 
+            `do_sample=False`. You can deactivate top_k sampling by providing `top_k=0` or `top_k=None`. Note 
+            that if you provide both `top_k` and `top_p`, the `top_k` is applied before.
+        top_p : float | None, optional
+            The probability density covering the new tokens to consider for random sampling, by default 0.9. Not used if 
+            `do_sample=False`. You can deactivate top_p sampling by providing `top_p=1` or `top_p=None`. Note 
+            that if you provide both `top_k` and `top_p`, the `top_k` is applied before.
+        temperature : float, optional
+            How to cool down the probability distribution. Value between 1 (no cooldown) and 0 (greedy search,
+            no randomness), by default 0.9. Passing 0 is equivalent to setting `do_sample=False`.
+        batch_size : int | None, optional
+            Max batch size for the model forward pass. If `None`, will try to determine the largest possible batch
+            size that does not result in memory error. By default None.
+        seed : int | None, optional
+            An optional seed to force the generation to be reproducible.
+
+        Returns
+        -------
+        list[GenericConversation]
+            The conversation objects, with the dialogue histories updated with the current turn, in the same
+            order as `prompts`.
+        """
+
+        if seed is not None:
+            utils.set_all_seeds(seed)
+
+        # Override the default `self.model.generation_config` with our config to be sure of the generation mode
+        generation_config = self.create_generation_config(max_new_tokens=max_new_tokens, min_new_tokens=min_new_tokens,
+                                                          do_sample=do_sample, top_k=top_k, top_p=top_p,
+                                                          temperature=temperature)
+        pad_token_id = generation_config.pad_token_id
+
+        if conv_histories is None:
+            conv_histories = [self.get_empty_conversation() for _ in prompts]
+        if len(conv_histories) != len(prompts):
+            raise ValueError('There must be exactly one conversation for each prompt.')
+        if len(prompts) == 0:
+            return conv_histories
+
+        # Add the prompts to the conversations, and tokenize all of them at once
+        full_prompts = []
+        for conv_history, prompt in zip(conv_histories, prompts):
+            full_prompts.append(conv_history.prepare_for_generation(system_prompt, prompt))
+        inputs = self.tokenizer(full_prompts, return_attention_mask=False).input_ids
+
+        # Sort the prompts by decreasing length so that each batch needs as little padding as possible
+        order = np.argsort([-len(input) for input in inputs], kind='stable')
+
+        if batch_size is None:
+            batch_size = self.infer_best_batch_size(len(inputs[order[0]]), max_new_tokens, len(prompts))
+
+        responses = [None]*len(prompts)
+        start = 0
+        while start < len(prompts):
+            indices = order[start:start+batch_size]
+
+            # Left-pad the prompts to the longest one of the batch (which is the first one)
+            batch_input_length = len(inputs[indices[0]])
+            batch_input = torch.full((len(indices), batch_input_length), pad_token_id)
+            attention_mask = torch.zeros_like(batch_input)
+            for i, index in enumerate(indices):
+                length = len(inputs[index])
+                batch_input[i, -length:] = torch.tensor(inputs[index])
+                attention_mask[i, -length:] = 1
+            # Copy both at once through the staging buffer
+            batch_input, attention_mask = self._copy_input_to_device(torch.stack([batch_input, attention_mask]))
+
+            # Create the stopping criteria in case the model has some extra eos tokens to process
+            stopping_criteria, _ = self.create_stopping_criteria(batch_input_length)
+
+            # This will lower the batch size if needed, in case of possible OOM. Only the first `batch_size`
+            # prompts are then processed, the other ones go in the next batch
+            outputs, batch_size = self.oom_safe_batch_generation(batch_input, generation_config=generation_config,
+                                                                 stopping_criteria=stopping_criteria,
+                                                                 batch_size=len(indices),
+                                                                 attention_mask=attention_mask, **kwargs)
+            indices = indices[:batch_size]
+            start += len(indices)
+            
+            # Post-process the sequences according to potential extra eos tokens
+            batch_responses = stopping.post_process_sequences(outputs[:, batch_input_length:], self.tokenizer,
+                                                              stopping_patterns=None,
+                                                              extra_eos_tokens=self.extra_eos_tokens)
+            
+            # Put the responses back in the original order of the prompts
+            for index, response in zip(indices, batch_responses):
+                responses[index] = response
+
+        # Append outputs to the convs
+        for conv_history, response in zip(conv_histories, responses):
+            conv_history.append_model_message(response)
+
+        return conv_histories
+
+
+    def _tokenize_conversation(self, conv_history: GenericConversation, full_prompt: str) -> torch.Tensor:
+        """Tokenize `full_prompt`, the prompt of the conversation. If the tokenizer allows it, and the prompt of the
+        previous turn is a prefix of it, only the new part of the prompt is tokenized.
+
+        Parameters
+        ----------
+        conv_history : GenericConversation
+            The current conversation.
+        full_prompt : str
+            The prompt of the conversation.
+
+        Returns
+        -------
+        torch.Tensor
+            The tokenized prompt, of shape (1, input_length).
+        """
+
+        prefix = conv_history._tokenized_prefix
+        if self._delta_tokenization and prefix is not None and prefix[0] == self.model_name and \
+            full_prompt.startswith(prefix[1]):
+            delta = full_prompt[len(prefix[1]):]
+        else:
+            delta = None
+
+        if delta is not None and self._can_split_tokenization(prefix[1], delta):
+            input_ids = prefix[2] + self.tokenizer(delta, add_special_tokens=False).input_ids
+        else:
+            input_ids = self.tokenizer(full_prompt, return_attention_mask=False).input_ids
+
+        conv_history._tokenized_prefix = (self.model_name, full_prompt, input_ids)
+
+        return torch.tensor([input_ids])
+    
+
+    def _can_split_tokenization(self, text: str, continuation: str) -> bool:
+        """Check if tokenizing `text` and `continuation` separately gives the same tokens as tokenizing
+        `text + continuation`. This is not the case if a token spans the boundary, e.g. a run of whitespaces or a
+        word cut in half, so the characters around the boundary are tokenized both ways and compared.
+        """
+
+        tail = text[-DELTA_TOKENIZATION_WINDOW:]
+        head = continuation[:DELTA_TOKENIZATION_WINDOW]
+        joint, *split = self.tokenizer([tail + head, tail, head], add_special_tokens=False,
+                                       return_attention_mask=False).input_ids
+
+        return joint == split[0] + split[1]
+    
+
+    def _extend_conversation_cache(self, conv_history: GenericConversation,
+                                   input: torch.Tensor) -> tuple[tuple[torch.Tensor]] | None:
+        """Compute the K-V cache of `input[:, :-1]`, the tokenized prompt of the conversation, by reusing the cache
+        of the previous turn for their common prefix. The cache is saved on `conv_history` for the next turn
+        (`generate()` does not return its own cache, so the cache of the answer is computed at the next turn).
+
+        Parameters
+        ----------
+        conv_history : GenericConversation
+            The current conversation.
+        input : torch.Tensor
+            The tokenized prompt of the conversation, on `self.input_device`.
+
+        Returns
+        -------
+        tuple[tuple[torch.Tensor]] | None
+            The K-V cache to pass to `generate()`, or None if it cannot be used with the current model.
+        """
+
+        input_length = input.shape[-1]
+        if input_length < 2 or not self._reuse_conversation_cache:
+            conv_history.erase_cache()
+            return None
+        
+        # The cache can only be reused by the same model instance (two instances of the same model may live on
+        # different devices), and if the previous prompt is a prefix of the new one (this is not the case if the
+        # history or system prompt were modified in-between). The model attributes are also part of the key, in
+        # case the id of a deleted instance is reused by a new one
+        cached_input_ids = conv_history._cached_input_ids
+        past_key_values = conv_history._cached_past
+        owner = (id(self), self.model_name, self._dtype_category, self.input_device)
+        if past_key_values is None or conv_history._cache_owner != owner or \
+            cached_input_ids.shape[-1] > input_length - 1 or \
+            not torch.equal(input[:, :cached_input_ids.shape[-1]], cached_input_ids):
+            cached_length = 0
+            past_key_values = None
+        else:
+            cached_length = cached_input_ids.shape[-1]
+
+        new_tokens = input[:, cached_length:-1]
+        if new_tokens.shape[-1] > 0:
+            attention_mask = torch.ones_like(input[:, :-1])
+            with torch.inference_mode():
+                past_key_values = self.model(new_tokens, past_key_values=past_key_values,
+                                             attention_mask=attention_mask, use_cache=True).past_key_values
+            # The cache is given to `generate()`, which must not extend the one we store
+            past_key_values = _to_legacy_cache(past_key_values)
+        
+        # Only models using the usual cache layout (batch, heads, sequence, head_dim) are supported
+        if not all(tensor.dim() == 4 for layer in past_key_values for tensor in layer):
+            self._reuse_conversation_cache = False
+            conv_history.erase_cache()
+            return None
+        
+        conv_history._cached_input_ids = input[:, :-1]
+        conv_history._cached_past = past_key_values
+        conv_history._cache_owner = owner
+
+        return past_key_values
+    
+
     def get_empty_conversation(self) -> GenericConversation:
         """Return a new empty conversation with the template of the current model."""
         return get_conversation_template(self.model_name)
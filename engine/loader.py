@@ -525,6 +525,35 @@ def estimate_model_gpu_footprint(model_name, quantization_8bits: bool = False, q
 
 
 
+def _flash_attention_2_kwargs(dtype: torch.dtype) -> dict:
+    """Return the additional kwargs to load a model with FlashAttention-2, or an empty dict if it is not
+    available. It needs half precision, an Ampere gpu (or newer), the `flash_attn` package, and
+    transformers>=4.36.
+
+    Parameters
+    ----------
+    dtype : torch.dtype
+        The dtype which will be used for the model.
+
+    Returns
+    -------
+    dict
+        The additional kwargs.
+    """
+
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability(0)[0] < 8:
+        return {}
+    if dtype not in (torch.float16, torch.bfloat16):
+        return {}
+    
+    from transformers import utils as transformers_utils
+    is_flash_attn_2_available = getattr(transformers_utils, 'is_flash_attn_2_available', None)
+    if is_flash_attn_2_available is None or not is_flash_attn_2_available():
+        return {}
+    
+    return {'attn_implementation': 'flash_attention_2'}
+
+
 def load_model(model_name: str, quantization_8bits: bool = False, quantization_4bits: bool = False,
                dtype: torch.dtype | None = None, max_fraction_gpu_0: float = 0.8, max_fraction_gpus: float = 0.8,
                device_map: dict | str | None = None, gpu_rank: int = 0):
@@ -633,11 +662,23 @@ def load_model(model_name: str, quantization_8bits: bool = False, quantization_4
 
     # this with statement is not useful anymore since bitsandbytes v0.41.0
     # with warnings_suppressor.swallow_bitsandbytes_prints():
-    # Load model
-    model = AutoModelForCausalLM.from_pretrained(ALL_MODELS_MAPPING[model_name], device_map=device_map,
-                                                 torch_dtype=dtype, load_in_8bit=quantization_8bits,
-                                                 load_in_4bit=quantization_4bits, low_cpu_mem_usage=True,
-                                                 **additional_kwargs)
+    # Load model. FlashAttention-2 is used if possible: its fused kernel never materializes the full attention
+    # matrix, which is much faster and lighter for long prompts
+    flash_attention_kwargs = _flash_attention_2_kwargs(dtype)
+    try:
+        model = AutoModelForCausalLM.from_pretrained(ALL_MODELS_MAPPING[model_name], device_map=device_map,
+                                                     torch_dtype=dtype, load_in_8bit=quantization_8bits,
+                                                     load_in_4bit=quantization_4bits, low_cpu_mem_usage=True,
+                                                     **additional_kwargs, **flash_attention_kwargs)
+    # Not all architectures support FlashAttention-2 (this is checked before loading the weights)
+    except ValueError:
+        if len(flash_attention_kwargs) == 0:
+            raise
+        flash_attention_kwargs = {}
+        model = AutoModelForCausalLM.from_pretrained(ALL_MODELS_MAPPING[model_name], device_map=device_map,
+                                                     torch_dtype=dtype, load_in_8bit=quantization_8bits,
+                                                     load_in_4bit=quantization_4bits, low_cpu_mem_usage=True,
+                                                     **additional_kwargs)
     
     # If the flag is active we directly put our model on one gpu without using any device_map (this is 
     # more efficient). But if the model is quantized, this is already done automatically because quantization
@@ -646,8 +687,9 @@ def load_model(model_name: str, quantization_8bits: bool = False, quantization_4
         # This operation is in-place for nn.Module
         model.cuda(gpu_rank)
 
-    # For some reason bettertransformer is supported for codegen2 models but makes them crash during the forward
-    if not ('codegen2-' in model_name):
+    # For some reason bettertransformer is supported for codegen2 models but makes them crash during the forward.
+    # It is also useless if the model already uses FlashAttention-2
+    if not ('codegen2-' in model_name) and len(flash_attention_kwargs) == 0:
         # Convert to better transformer to use Pytorch optimizations if supported by the model
         try:
             model = model.to_bettertransformer()
@@ -675,10 +717,11 @@ def load_tokenizer(model_name: str):
     if model_name not in ALLOWED_MODELS:
         raise ValueError(f'The model name must be one of {*ALLOWED_MODELS,}.') 
     
+    # Use the fast (Rust) tokenizers by default, as they are much faster to encode long prompts
+    additional_kwargs = {'use_fast': True}
+    # This may override `use_fast` for models with buggy fast tokenizers
     if model_name in ALL_MODELS_ADDITIONAL_TOKENIZER_KWARGS.keys():
-        additional_kwargs = ALL_MODELS_ADDITIONAL_TOKENIZER_KWARGS[model_name]
-    else:
-        additional_kwargs = {}
+        additional_kwargs.update(ALL_MODELS_ADDITIONAL_TOKENIZER_KWARGS[model_name])
     
     tokenizer = AutoTokenizer.from_pretrained(ALL_MODELS_MAPPING[model_name], **additional_kwargs)
 
@@ -21,8 +21,9 @@ class GenericPromptTemplate(object):
         self.extra_eos_tokens = []
 
 
-    def get_prompt(self, prompt: str, model_context: str = '', suffix: str = '', system_prompt: str = '') -> str:
-        """Format the `prompt` according to `self.mode`.
+    def get_prompt(self, prompt: str, model_context: str = '', suffix: str = '', system_prompt: str = '',
+                   mode: str | None = None) -> str:
+        """Format the `prompt` according to `mode`, or `self.mode` if not provided.
 
         Parameters
         ----------
@@ -35,6 +36,8 @@ class GenericPromptTemplate(object):
         system_prompt : str, optional
             An optional system prompt to append at the beginning for chat mode. This is ignored for all modes
             except `chat`, by default ''.
+        mode : str | None, optional
+            The formatting mode to use for this prompt only. If `None`, use `self.mode`. By default None.
 
         Returns
         -------
@@ -42,13 +45,18 @@ class GenericPromptTemplate(object):
             Formatted prompt.
         """
 
-        if self.mode == 'default':
+        if mode is None:
+            mode = self.mode
+        elif mode not in PROMPT_MODES:
+            raise ValueError(f'The mode for creating the prompt must be one of {*PROMPT_MODES,}')
+
+        if mode == 'default':
             return self.format_default(prompt, model_context=model_context, suffix=suffix, system_prompt=system_prompt)
-        elif self.mode == 'generation':
+        elif mode == 'generation':
             return self.format_generation(prompt, model_context=model_context)
-        elif self.mode == 'infill':
+        elif mode == 'infill':
             return self.format_infill(prompt, model_context=model_context, suffix=suffix)
-        elif self.mode == 'chat':
+        elif mode == 'chat':
             return self.format_chat(prompt, model_context=model_context, system_prompt=system_prompt)
         
 
@@ -1,8 +1,10 @@
 import re
+import threading
+from functools import lru_cache
 
 import torch
 import numpy as np
-from transformers import PreTrainedTokenizerBase, StoppingCriteria
+from transformers import PreTrainedTokenizerBase, StoppingCriteria, LogitsProcessor
 
 from engine.code_parser import CodeParser, PythonParser
 
@@ -25,13 +27,24 @@ EXTENDED_CODE_STOP_PATTERNS = CODE_STOP_PATTERNS + (
 )
 
 
+@lru_cache(maxsize=32)
+def _compile_patterns(patterns: tuple[str]) -> re.Pattern | None:
+    """Compile `patterns` into a single regex matching any of them, so that a text is scanned only once for all
+    patterns instead of once per pattern. Returns `None` if there are no patterns.
+    """
+    if len(patterns) == 0:
+        return None
+    # Longest patterns first, so that the longest match is found when patterns overlap
+    return re.compile('|'.join(re.escape(pattern) for pattern in sorted(patterns, key=len, reverse=True)))
+
+
 class TextPatternStopping(StoppingCriteria):
     """Stop generation upon meeting any of the `stopping_patterns` or `extra_eos_tokens`.
     """
 
     def __init__(self, prompt_ids_length: int, tokenizer: PreTrainedTokenizerBase,
                  stopping_patterns: list[str] | tuple[str] | None, extra_eos_tokens: list[str] | None = None,
-                 parser: CodeParser | None = None):
+                 parser: CodeParser | None = None, extra_eos_tokens_ids: torch.Tensor | None = None):
 
         super().__init__()
         self.prompt_ids_length = prompt_ids_length
@@ -40,10 +53,26 @@ class TextPatternStopping(StoppingCriteria):
         self.stopping_patterns = tuple() if stopping_patterns is None else tuple(stopping_patterns)
         self.extra_eos_tokens = tuple() if extra_eos_tokens is None else tuple(extra_eos_tokens)
         self.all_patterns = self.stopping_patterns + self.extra_eos_tokens
+        # Optional pre-encoded ids of the `extra_eos_tokens` (when they are all single tokens), on the same device
+        # as the model outputs, to check them without decoding
+        self.extra_eos_tokens_ids = extra_eos_tokens_ids
 
         if len(self.all_patterns) == 0:
             raise ValueError('You did not provide any patterns or extra eos tokens upon which to stop generation.')
         
+        # Patterns to check on the decoded sequences (the extra eos can be checked directly on the ids if they
+        # were encoded)
+        patterns = self.stopping_patterns if self.extra_eos_tokens_ids is not None else self.all_patterns
+        self._patterns_regex = _compile_patterns(patterns)
+        # A pattern which was not in a sequence at the previous step can only be in its last tokens (all patterns
+        # are at least one character per token). The additional token makes sure that the start of a pattern is
+        # never the start of the decoded text, which may be stripped by the tokenizer
+        self._window_length = max(map(len, patterns), default=0) + 1
+
+        # Whether each sequence is done, and the number of tokens generated, at the last call
+        self._done = None
+        self._length = 0
+        
 
     def __repr__(self):
         return f'TextPatternStopping{*self.all_patterns,}'
@@ -98,21 +127,151 @@ class TextPatternStopping(StoppingCriteria):
         """
 
         outputs = input_ids[:, self.prompt_ids_length:]
+
+        # The sequences must be parsed from their start, so we cannot only check their last tokens
+        if self.parser is not None:
+            self._done = self._parsed_sequences_done(outputs)
+            self._length = outputs.shape[-1]
+            return all(self._done)
+
+        # The done sequences are remembered between calls, so that only the last tokens of the other ones need to
+        # be decoded and scanned. The criteria may be reused for another call to `generate()`, in which case we
+        # start again from scratch
+        new_generation = self._done is None or len(self._done) != len(outputs) or outputs.shape[-1] <= self._length
+        done = [False]*len(outputs) if new_generation else list(self._done)
+        self._length = outputs.shape[-1]
+
+        if self.extra_eos_tokens_ids is not None:
+            done_with_eos = torch.isin(outputs, self.extra_eos_tokens_ids).any(dim=-1).tolist()
+            done = [previous or eos for previous, eos in zip(done, done_with_eos)]
+
+        unfinished = [i for i, sequence_done in enumerate(done) if not sequence_done]
+        if self._patterns_regex is not None and len(unfinished) > 0:
+            new_tokens = outputs[unfinished] if new_generation else outputs[unfinished, -self._window_length:]
+            for i, sequence in zip(unfinished, self.tokenizer.batch_decode(new_tokens)):
+                done[i] = self._patterns_regex.search(sequence) is not None
+
+        self._done = done
+
+        return all(done)
+    
+
+    def _parsed_sequences_done(self, outputs: torch.Tensor) -> list[bool]:
+        """Check which of the PROMPT-TRUNCATED `outputs` are finished, when the stopping patterns must be
+        checked on the parsed sequences.
+        """
+
+        # If the extra eos were encoded, check them directly on the ids, and only decode the sequences which
+        # are not done yet to check the stopping patterns
+        if self.extra_eos_tokens_ids is not None:
+            done = torch.isin(outputs, self.extra_eos_tokens_ids).any(dim=-1).tolist()
+            unfinished = [i for i, sequence_done in enumerate(done) if not sequence_done]
+            if len(unfinished) == 0 or len(self.stopping_patterns) == 0:
+                return done
+            
+            generated_sequences = self.tokenizer.batch_decode(outputs[unfinished])
+            generated_sequences = [self.parser(sequence) for sequence in generated_sequences]
+            for i, sequence_done in zip(unfinished, self.check_patterns(generated_sequences, self.stopping_patterns)):
+                done[i] = sequence_done
+            return done
+        
         generated_sequences = self.tokenizer.batch_decode(outputs)
+
+        return list(self.sequences_done(generated_sequences))
+    
+
+    def sequences_done(self, generated_sequences: list[str]) -> list[bool]:
+        """Check which of the `generated_sequences` are finished, i.e. contain at least one stopping pattern
+        or extra eos.
+
+        Parameters
+        ----------
+        generated_sequences : list[str]
+            Decoded PROMPT-TRUNCATED outputs of the model.
+
+        Returns
+        -------
+        list[bool]
+            Whether each sequence is finished or not.
+        """
         
         # If we don't use a parser, just check against all patterns
         if self.parser is None:
-            done_sequences = self.check_patterns(generated_sequences, self.all_patterns)
-            return all(done_sequences)
+            return self.check_patterns(generated_sequences, self.all_patterns)
         # Else first check the eos in the full sequences, then parse and check for the other patterns
         else:
             done_with_eos = self.check_patterns(generated_sequences, self.extra_eos_tokens)
             parsed_sequences = [self.parser(sequence) for sequence in generated_sequences]
             done_with_patterns = self.check_patterns(parsed_sequences, self.stopping_patterns)
-            return all(np.logical_or(done_with_eos, done_with_patterns))
+            return list(np.logical_or(done_with_eos, done_with_patterns))
         
 
 
+class FirstSequenceStopping(StoppingCriteria):
+    """Stop generation as soon as any of the sequences is finished, i.e. generated an eos or met the
+    `pattern_stopping` criteria. This is used to free the place of a finished sequence in the batch as soon as
+    possible, when other sequences are waiting for one.
+    """
+
+    def __init__(self, prompt_ids_length: int, eos_token_id: torch.Tensor,
+                 pattern_stopping: TextPatternStopping | None = None):
+
+        super().__init__()
+        self.prompt_ids_length = prompt_ids_length
+        self.eos_token_id = eos_token_id
+        self.pattern_stopping = pattern_stopping
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+
+        outputs = input_ids[:, self.prompt_ids_length:]
+        if bool(torch.isin(outputs, self.eos_token_id).any()):
+            return True
+        
+        if self.pattern_stopping is None:
+            return False
+        # This updates the done sequences of the criteria
+        self.pattern_stopping(input_ids, scores)
+        return any(self.pattern_stopping._done)
+    
+
+
+class SequenceMinNewTokensLogitsProcessor(LogitsProcessor):
+    """Prevent each sequence from generating an eos before it has its own minimum number of new tokens. This is
+    the same as `min_new_tokens` in `GenerationConfig`, but with a different value for each sequence of the batch,
+    e.g. when the sequences already generated a different number of tokens before being batched together.
+    """
+
+    def __init__(self, prompt_ids_length: int, min_new_tokens: torch.Tensor, eos_token_id: torch.Tensor):
+
+        super().__init__()
+        self.prompt_ids_length = prompt_ids_length
+        self.min_new_tokens = min_new_tokens
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+
+        generated_length = input_ids.shape[-1] - self.prompt_ids_length
+        # The batch may have been cut (e.g. after an OOM), in which case only the first sequences are generated
+        suppress_eos = self.min_new_tokens[:len(scores)] > generated_length
+        scores[:, self.eos_token_id] = torch.where(suppress_eos[:, None], -float('inf'), scores[:, self.eos_token_id])
+        return scores
+    
+
+
+class EventStopping(StoppingCriteria):
+    """Stop generation as soon as `event` is set. This allows to interrupt a generation running in another thread.
+    """
+
+    def __init__(self, event: threading.Event):
+
+        super().__init__()
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        return self.event.is_set()
+    
+
+
 class OutOfIndentationStopping(StoppingCriteria):
     """Stop generation if we detect any newline character (or start of string) immeditaly followed by a
     non-space character (i.e. the code/text is not indented).
@@ -0,0 +1,72 @@
+import unittest
+import importlib.util
+
+HAS_DEPENDENCIES = all(importlib.util.find_spec(name) is not None for name in ('torch', 'transformers'))
+
+
+@unittest.skipUnless(HAS_DEPENDENCIES, 'torch and transformers are needed.')
+class ConversationCacheTest(unittest.TestCase):
+    """Check that the K-V cache of a conversation stays aligned with its token ids across turns."""
+
+    def setUp(self):
+
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        from engine.generation import HFModel
+        from engine.conversation_template import GenericConversation
+
+        torch.manual_seed(0)
+        config = GPT2Config(vocab_size=64, n_positions=64, n_embd=16, n_layer=2, n_head=2)
+
+        # Only set the attributes needed to extend the conversation cache, instead of loading a pretrained model
+        self.model = HFModel.__new__(HFModel)
+        self.model.model = GPT2LMHeadModel(config).eval()
+        self.model.model_name = 'tiny-gpt2'
+        self.model._dtype_category = 'float32'
+        self.model.input_device = 'cpu'
+        self.model._reuse_conversation_cache = True
+
+        self.conversation = GenericConversation(eos_token='')
+
+
+    def cached_length(self) -> int:
+        """Return the sequence length of the K-V cache stored on the conversation."""
+        return self.conversation._cached_past[0][0].shape[-2]
+
+
+    def test_cached_length_unchanged_after_generate(self):
+
+        import torch
+
+        input = torch.randint(0, 64, (1, 10))
+        past_key_values = self.model._extend_conversation_cache(self.conversation, input)
+        cached_length = self.cached_length()
+        self.assertEqual(cached_length, self.conversation._cached_input_ids.shape[-1])
+
+        with torch.inference_mode():
+            self.model.model.generate(input, past_key_values=past_key_values, max_new_tokens=5, min_new_tokens=5,
+                                      do_sample=False, pad_token_id=0)
+
+        self.assertEqual(self.cached_length(), cached_length)
+
+
+    def test_cache_extended_at_next_turn(self):
+
+        import torch
+
+        input = torch.randint(0, 64, (1, 10))
+        past_key_values = self.model._extend_conversation_cache(self.conversation, input)
+        with torch.inference_mode():
+            outputs = self.model.model.generate(input, past_key_values=past_key_values, max_new_tokens=5,
+                                                min_new_tokens=5, do_sample=False, pad_token_id=0)
+
+        # The next prompt starts with the previous prompt and answer
+        next_input = torch.cat([outputs, torch.randint(0, 64, (1, 4))], dim=-1)
+        self.model._extend_conversation_cache(self.conversation, next_input)
+
+        self.assertEqual(self.cached_length(), next_input.shape[-1] - 1)
+        self.assertTrue(torch.equal(self.conversation._cached_input_ids, next_input[:, :-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()